@@ -3,14 +3,23 @@ import os
 
 import streamlit as st
 from dotenv import load_dotenv
-from pypdf import PdfReader
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
+# rag_pipeline 內的 langchain / FAISS 都是第一次使用時才 import，
+# 所以這裡 import 很快，不會拖慢 Streamlit 每次重跑與第一次繪製。
 from rag_pipeline import (
     build_docs_from_text,
     build_vector_store,
     build_qa_chain,
     save_vector_store,
-    load_vector_store,
+    get_cached_vector_store,
+    get_result_cache,
+    get_session_manager,
+    SessionBudgetExceeded,
+    load_doc_summaries,
+    preload_vector_store,
+    mark_timing,
+    get_timings,
     get_docs_stats_from_vector_store,
     get_source_names,
     semantic_search,
@@ -27,20 +36,11 @@ st.set_page_config(
     initial_sidebar_state="expanded",
 )
 
+# 若有設定 ASKMYDOCS_PRELOAD_PATH，背景預載該向量庫到共用快取（每個 process 只做一次）
+preload_vector_store()
 
-# ========= 初始化 Session State =========
-
-if "vector_store" not in st.session_state:
-    st.session_state.vector_store = None
-
-if "qa_chain" not in st.session_state:
-    st.session_state.qa_chain = None
 
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-
-if "docs_stats" not in st.session_state:
-    st.session_state.docs_stats = None
+# ========= 初始化 Session State =========
 
 if "temperature" not in st.session_state:
     st.session_state.temperature = 0.2
@@ -60,9 +60,29 @@ if "language_mode" not in st.session_state:
 if "answer_style" not in st.session_state:
     st.session_state.answer_style = "詳細說明"
 
-if "doc_summaries" not in st.session_state:
-    # { filename: summary_text }
-    st.session_state.doc_summaries = {}
+
+# ========= 大型狀態交給 SessionStoreManager =========
+# 向量庫、qa_chain、對話、摘要不放在 st.session_state，而是放在 manager 裡，
+# session 閒置或整體記憶體超過上限時會被 spill 到磁碟，下次操作時自動載回。
+# acquire() 讓 session 在這次 script 執行期間不會被 spill（script 最後 release()）；
+# 欄位一律透過 session_manager.update / append_message 寫入。
+# sess.doc_summaries 格式：{ filename: summary_text }
+
+session_manager = get_session_manager()
+_ctx = get_script_run_ctx()
+session_id = _ctx.session_id if _ctx is not None else "local"
+sess = session_manager.acquire(session_id)
+
+if sess.vector_store is not None and sess.qa_chain is None:
+    # 從磁碟載回的 session，依目前設定重建 qa_chain
+    session_manager.update(
+        session_id,
+        qa_chain=build_qa_chain(
+            sess.vector_store,
+            k=st.session_state.top_k,
+            temperature=st.session_state.temperature,
+        ),
+    )
 
 
 # ========= Sidebar：設定與工具 =========
@@ -118,36 +138,44 @@ with st.sidebar:
     st.markdown("---")
 
     if st.button("🧹 清空對話"):
-        st.session_state.messages = []
+        session_manager.update(session_id, messages=[])
         st.success("對話已清空。")
 
     if st.button("🗑️ 清空向量庫"):
-        st.session_state.vector_store = None
-        st.session_state.qa_chain = None
-        st.session_state.docs_stats = None
-        st.session_state.doc_summaries = {}
+        session_manager.update(
+            session_id,
+            vector_store=None,
+            qa_chain=None,
+            docs_stats=None,
+            doc_summaries={},
+        )
         st.success("向量庫已清空。")
 
     if st.button("💾 從磁碟載入向量庫 (faiss_db)"):
         try:
-            vector_store = load_vector_store("faiss_db")
-            st.session_state.vector_store = vector_store
-            st.session_state.qa_chain = build_qa_chain(
-                vector_store,
-                k=st.session_state.top_k,
-                temperature=st.session_state.temperature,
-            )
-            st.session_state.docs_stats = get_docs_stats_from_vector_store(
-                vector_store
+            vector_store = get_cached_vector_store("faiss_db")
+            session_manager.update(
+                session_id,
+                vector_store=vector_store,
+                shared_path="faiss_db",
+                qa_chain=build_qa_chain(
+                    vector_store,
+                    k=st.session_state.top_k,
+                    temperature=st.session_state.temperature,
+                ),
+                docs_stats=get_docs_stats_from_vector_store(vector_store),
+                doc_summaries=load_doc_summaries(
+                    "faiss_db", getattr(vector_store, "snapshot_version", None)
+                ),
             )
             st.success("已從 faiss_db 成功載入向量庫！")
         except Exception as e:
             st.error(f"載入失敗：{e}")
 
     # 下載對話紀錄
-    if st.session_state.messages:
+    if sess.messages:
         md_lines = []
-        for m in st.session_state.messages:
+        for m in sess.messages:
             role = "使用者" if m["role"] == "user" else "AI"
             md_lines.append(f"### {role}\n\n{m['content']}\n")
         md_text = "\n".join(md_lines)
@@ -158,6 +186,18 @@ with st.sidebar:
             mime="text/markdown",
         )
 
+    with st.expander("🧠 Session 記憶體"):
+        for name, value in session_manager.metrics().items():
+            if name.endswith("bytes"):
+                value = f"{value / 2**20:.1f} MB"
+            st.caption(f"{name}：{value}")
+
+    timings = get_timings()
+    if timings:
+        with st.expander("⏱️ 啟動時間"):
+            for name, sec in timings.items():
+                st.caption(f"{name}：{sec:.2f} 秒")
+
 
 # ========= Main 區：標題與說明 =========
 
@@ -229,6 +269,8 @@ st.write(
     "之後你可以像問人一樣，直接用自然語言向文件提問。"
 )
 
+mark_timing("first_paint")
+
 
 
 # ========= 檔案上傳與向量庫建立 =========
@@ -256,6 +298,8 @@ if uploaded_files and st.button("📚 建立 / 更新知識庫"):
 
         if f.type == "application/pdf":
             try:
+                from pypdf import PdfReader
+
                 pdf_reader = PdfReader(io.BytesIO(file_bytes))
                 for page in pdf_reader.pages:
                     page_text = page.extract_text() or ""
@@ -281,7 +325,9 @@ if uploaded_files and st.button("📚 建立 / 更新知識庫"):
         # 自動摘要
         with st.spinner(f"正在為 {f.name} 產生摘要..."):
             try:
-                summary = summarize_text(text, language_mode=lang_code)
+                summary = summarize_text(
+                    text, language_mode=lang_code, cache=get_result_cache()
+                )
                 doc_summaries[f.name] = summary
             except Exception as e:
                 doc_summaries[f.name] = f"產生摘要時發生錯誤：{e}"
@@ -291,21 +337,29 @@ if uploaded_files and st.button("📚 建立 / 更新知識庫"):
     else:
         with st.spinner("正在建立向量資料庫（Embedding + Indexing）..."):
             vector_store = build_vector_store(all_docs)
-            st.session_state.vector_store = vector_store
-            st.session_state.qa_chain = build_qa_chain(
-                vector_store,
-                k=st.session_state.top_k,
-                temperature=st.session_state.temperature,
-            )
-            st.session_state.docs_stats = get_docs_stats_from_vector_store(
-                vector_store
-            )
-            st.session_state.doc_summaries = doc_summaries
+            try:
+                session_manager.update(
+                    session_id,
+                    vector_store=vector_store,
+                    qa_chain=build_qa_chain(
+                        vector_store,
+                        k=st.session_state.top_k,
+                        temperature=st.session_state.temperature,
+                    ),
+                    docs_stats=get_docs_stats_from_vector_store(vector_store),
+                    doc_summaries=doc_summaries,
+                )
+            except SessionBudgetExceeded as e:
+                st.error(str(e))
+                session_manager.release(session_id)
+                st.stop()
 
             if st.session_state.persist_enabled:
                 try:
-                    save_vector_store(vector_store, "faiss_db")
-                    st.info("向量庫已存至本機資料夾：faiss_db")
+                    version = save_vector_store(
+                        vector_store, "faiss_db", doc_summaries=doc_summaries
+                    )
+                    st.info(f"向量庫已存至本機資料夾：faiss_db（版本 {version}）")
                 except Exception as e:
                     st.error(f"儲存向量庫失敗：{e}")
 
@@ -314,8 +368,8 @@ if uploaded_files and st.button("📚 建立 / 更新知識庫"):
 
 # ========= 文件統計資訊 & 摘要 =========
 
-if st.session_state.docs_stats:
-    stats = st.session_state.docs_stats
+if sess.docs_stats:
+    stats = sess.docs_stats
     st.markdown(
         f"""**目前向量庫統計：**  
 - Chunk 數量：`{stats["num_docs"]}`  
@@ -329,9 +383,9 @@ if st.session_state.docs_stats:
         for src, cnt in stats["per_source"].items():
             st.markdown(f"- `{src}`：{cnt} chunks")
 
-if st.session_state.doc_summaries:
+if sess.doc_summaries:
     with st.expander("📄 文件摘要（Auto Summary）"):
-        for fname, summary in st.session_state.doc_summaries.items():
+        for fname, summary in sess.doc_summaries.items():
             st.markdown(f"### 📘 {fname}")
             st.write(summary)
 
@@ -340,7 +394,7 @@ st.divider()
 
 # ========= Semantic Search & 文件比較 =========
 
-if st.session_state.vector_store is not None:
+if sess.vector_store is not None:
     col1, col2 = st.columns(2)
 
     with col1:
@@ -350,7 +404,7 @@ if st.session_state.vector_store is not None:
             with st.spinner("搜尋中…"):
                 try:
                     results = semantic_search(
-                        st.session_state.vector_store, semantic_query, k=5
+                        sess.vector_store, semantic_query, k=5
                     )
                     if not results:
                         st.info("找不到相關片段。")
@@ -369,7 +423,7 @@ if st.session_state.vector_store is not None:
     with col2:
         st.markdown("### 📊 文件比較（Document Compare）")
         try:
-            sources = get_source_names(st.session_state.vector_store)
+            sources = get_source_names(sess.vector_store)
         except Exception as e:
             sources = []
             st.error(f"取得來源檔名失敗：{e}")
@@ -386,10 +440,11 @@ if st.session_state.vector_store is not None:
                 with st.spinner("AI 正在比較兩份文件…"):
                     try:
                         cmp_result = compare_two_sources(
-                            st.session_state.vector_store,
+                            sess.vector_store,
                             src_a,
                             src_b,
                             language_mode=lang_code_cmp,
+                            cache=get_result_cache(),
                         )
                         st.markdown("#### 📎 比較結果")
                         st.write(cmp_result)
@@ -403,11 +458,11 @@ st.divider()
 
 # ========= 聊天區（RAG 問答） =========
 
-if st.session_state.qa_chain is None:
+if sess.qa_chain is None:
     st.info("請先上傳檔案並建立知識庫，或從 Sidebar 載入既有向量庫。")
 else:
     # 先把歷史訊息畫出來
-    for msg in st.session_state.messages:
+    for msg in sess.messages:
         with st.chat_message(msg["role"]):
             st.write(msg["content"])
 
@@ -416,7 +471,9 @@ else:
 
     if user_question:
         # 顯示使用者訊息
-        st.session_state.messages.append({"role": "user", "content": user_question})
+        session_manager.append_message(
+            session_id, {"role": "user", "content": user_question}
+        )
         with st.chat_message("user"):
             st.write(user_question)
 
@@ -437,7 +494,7 @@ else:
                         "考試解題模式": "exam",
                     }.get(st.session_state.answer_style, "detailed")
 
-                    result = st.session_state.qa_chain(
+                    result = sess.qa_chain(
                         {
                             "query": user_question,
                             "language_mode": lang_code,
@@ -445,6 +502,7 @@ else:
                         }
                     )
                     answer = result["result"]
+                    mark_timing("first_query")
                     sources = result.get("source_documents", [])
                     doc_scores = result.get("doc_scores", [])
                 except Exception as e:
@@ -453,8 +511,8 @@ else:
                     doc_scores = []
 
                 st.write(answer)
-                st.session_state.messages.append(
-                    {"role": "assistant", "content": answer}
+                session_manager.append_message(
+                    session_id, {"role": "assistant", "content": answer}
                 )
 
                 # 顯示來源片段 + 信心分數
@@ -478,3 +536,7 @@ else:
                             )
                             st.write(doc.page_content)
                             st.caption(str(meta))
+
+
+# script 跑完：之後這個 session 就可以依閒置時間被 spill
+session_manager.release(session_id)
@@ -0,0 +1,120 @@
+# bench_chunker.py
+#
+# 比較 rag_pipeline.split_text_offsets 與原本的 RecursiveCharacterTextSplitter：
+#   1. 先確認兩者在測試語料上切出的 chunk 完全相同
+#   2. 再比較速度與記憶體配置量
+# 邊界情況與隨機 fuzz 的等價測試在 tests/test_chunker.py（python -m pytest -q）。
+#
+# 用法：
+#   python bench_chunker.py                    # 用內建產生的中英混合語料
+#   python bench_chunker.py a.txt b.txt        # 用自己的檔案
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from rag_pipeline import (
+    CHUNK_OVERLAP,
+    CHUNK_SEPARATORS,
+    CHUNK_SIZE,
+    split_text_fast,
+)
+
+ZH_WORDS = ["檢索", "增強", "生成", "向量", "資料庫", "文件", "摘要", "模型", "語意", "搜尋"]
+EN_WORDS = ["retrieval", "augmented", "generation", "vector", "index", "chunk", "the", "a"]
+PUNCT = ["。", "！", "？", " ", "\n", "\n\n", "\n\n\n", "，", "  ", "\t"]
+
+
+def make_corpus(n_chars: int, seed: int = 0) -> str:
+    """
+    產生中英混合、段落長短不一的測試文字（包含很長沒有分隔符的段落）。
+    """
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < n_chars:
+        r = rng.random()
+        if r < 0.45:
+            tok = rng.choice(ZH_WORDS)
+        elif r < 0.8:
+            tok = rng.choice(EN_WORDS) + " "
+        elif r < 0.99:
+            tok = rng.choice(PUNCT)
+        else:
+            tok = "長" * rng.randint(100, 2000)
+        parts.append(tok)
+        size += len(tok)
+    return "".join(parts)
+
+
+def reference_split(text: str, chunk_size: int, chunk_overlap: int, separators) -> list:
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=separators,
+    )
+    return splitter.split_text(text)
+
+
+def check_equivalent(text: str, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=None):
+    separators = separators or CHUNK_SEPARATORS
+    expected = reference_split(text, chunk_size, chunk_overlap, separators)
+    actual = split_text_fast(text, chunk_size, chunk_overlap, separators)
+    if expected != actual:
+        for i, (x, y) in enumerate(zip(expected, actual)):
+            if x != y:
+                raise AssertionError(
+                    f"第 {i} 個 chunk 不同（size={chunk_size}, overlap={chunk_overlap}）：\n"
+                    f"  splitter: {x[:80]!r}\n  fast:     {y[:80]!r}"
+                )
+        raise AssertionError(f"chunk 數量不同：{len(expected)} vs {len(actual)}")
+    return len(actual)
+
+
+def measure(fn, text: str, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(text)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunker benchmark")
+    parser.add_argument("files", nargs="*", help="要測試的文字檔（省略則使用產生的語料）")
+    parser.add_argument("--chars", type=int, default=2_000_000, help="產生語料的字元數")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpora = []
+    for path in args.files:
+        with open(path, encoding="utf-8", errors="ignore") as f:
+            corpora.append((path, f.read()))
+    if not corpora:
+        corpora.append((f"generated-{args.chars}", make_corpus(args.chars)))
+
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=CHUNK_SEPARATORS,
+    )
+    for name, text in corpora:
+        n_chunks = check_equivalent(text)
+        t_ref, m_ref = measure(splitter.split_text, text, args.repeat)
+        t_fast, m_fast = measure(split_text_fast, text, args.repeat)
+        print(f"\n[{name}] {len(text):,} 字元，{n_chunks:,} chunks（輸出相同）")
+        print(f"  RecursiveCharacterTextSplitter: {t_ref:8.3f} s  peak {m_ref / 2**20:8.1f} MiB")
+        print(f"  split_text_fast:                {t_fast:8.3f} s  peak {m_fast / 2**20:8.1f} MiB")
+        print(f"  speedup: {t_ref / t_fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
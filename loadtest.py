@@ -0,0 +1,392 @@
+# loadtest.py
+#
+# 模擬多位使用者同時使用：以固定 QPS 混合送出 RAG 問答、語意搜尋與上傳（ingest），
+# 回報吞吐量、延遲百分位、錯誤率與記憶體變化，用來在上線前找出瓶頸。
+#
+# 預設會在同一個 process 內啟動 stub_openai_server，不會呼叫真的 OpenAI API：
+#   python loadtest.py --qps 20 --duration 60 --mix qa=0.6,search=0.3,ingest=0.1
+#   python loadtest.py --qps 50 --shards 4 --shard-mode process --stream --error-rate 0.02
+# 也可以指向已經在跑的 stub（或其他 OpenAI 相容服務）：
+#   python loadtest.py --base-url http://127.0.0.1:8765/v1
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from stub_openai_server import add_stub_arguments, config_from_args, start_stub_server
+
+ZH_QUERY_WORDS = ["檢索", "增強", "生成", "向量", "資料庫", "文件", "摘要", "模型", "語意", "搜尋"]
+EN_QUERY_WORDS = ["retrieval", "augmented", "generation", "vector", "index", "chunk"]
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """
+    "qa=0.6,search=0.3,ingest=0.1" → {"qa": 0.6, "search": 0.3, "ingest": 0.1}（自動正規化）。
+    """
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ("qa", "search", "ingest"):
+            raise ValueError(f"未知的 workload：{name}（可用 qa / search / ingest）")
+        mix[name] = float(weight or 1)
+    total = sum(mix.values())
+    if total <= 0:
+        raise ValueError("mix 的權重總和必須大於 0")
+    return {k: v / total for k, v in mix.items()}
+
+
+def _statm_rss(pid="self") -> int:
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def read_rss_bytes(child_pids=()) -> int:
+    """
+    目前 process 加上 child_pids（例如 ProcessShard 的子行程）的 RSS 總和；
+    沒有 /proc 的平台退而求其次用 ru_maxrss（自己與所有子行程的峰值）。
+    """
+    try:
+        total = _statm_rss()
+    except (OSError, ValueError, AttributeError):
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if child_pids:
+            rss += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return rss if os.uname().sysname == "Darwin" else rss * 1024
+    for pid in child_pids:
+        try:
+            total += _statm_rss(pid)
+        except (OSError, ValueError):
+            pass  # 子行程已經結束
+    return total
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, int(round(p / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+
+class Recorder:
+    """
+    執行緒安全地收集每一次請求的 (workload, 延遲, 是否成功)，以及定期的記憶體取樣。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.error_messages: Dict[str, int] = {}
+        self.memory: List[Dict] = []
+        self.dropped = 0
+        self.wall_seconds = 0.0
+
+    def record(self, op: str, latency: float, error: Exception = None):
+        with self._lock:
+            self.samples.setdefault(op, []).append(latency)
+            if error is not None:
+                self.errors[op] = self.errors.get(op, 0) + 1
+                key = f"{op}: {type(error).__name__}"
+                self.error_messages[key] = self.error_messages.get(key, 0) + 1
+
+    def sample_memory(self, elapsed: float, in_flight: int, child_pids=()):
+        total = read_rss_bytes(child_pids)
+        children = total - read_rss_bytes() if child_pids else 0
+        with self._lock:
+            self.memory.append(
+                {
+                    "t": round(elapsed, 2),
+                    "rss_mb": round(total / 2**20, 1),
+                    "child_rss_mb": round(children / 2**20, 1),
+                    "in_flight": in_flight,
+                }
+            )
+
+
+class Workloads:
+    """
+    準備好共用的向量庫與 qa_chain，提供三種 workload：
+    - qa：SimpleRetrievalQA（檢索 + LLM）
+    - search：semantic_search（只做 query embedding + 檢索）
+    - ingest：切塊 + embedding + 建一個新的小向量庫（模擬使用者上傳）
+    """
+
+    def __init__(self, args):
+        import rag_pipeline as rp
+        from bench_chunker import make_corpus
+
+        self.rp = rp
+        self.make_corpus = make_corpus
+        self.args = args
+        self._seed = 0
+        self._seed_lock = threading.Lock()
+
+        docs = []
+        for i in range(args.sources):
+            text = make_corpus(args.corpus_chars // args.sources, seed=i)
+            docs.extend(rp.build_docs_from_text(text, source_name=f"source_{i}.txt"))
+        start = time.perf_counter()
+        if args.shards > 1:
+            self.vector_store = rp.build_sharded_vector_store(
+                docs, num_shards=args.shards, by=args.shard_by, mode=args.shard_mode
+            )
+        else:
+            self.vector_store = rp.build_vector_store(docs)
+        self.build_seconds = time.perf_counter() - start
+        self.num_chunks = len(docs)
+
+        self.qa_chain = rp.build_qa_chain(self.vector_store, k=args.top_k)
+        # 換成指定重試次數的 client：預設 0，注入的錯誤才不會被 client 自動重試蓋掉
+        from langchain_openai import ChatOpenAI
+
+        self.qa_chain.llm = ChatOpenAI(
+            model=self.qa_chain.model,
+            temperature=self.qa_chain.temperature,
+            streaming=args.stream,
+            max_retries=args.max_retries,
+        )
+
+    def _next_seed(self) -> int:
+        with self._seed_lock:
+            self._seed += 1
+            return self._seed
+
+    def _query(self, rng: random.Random) -> str:
+        words = rng.sample(ZH_QUERY_WORDS, 2) + rng.sample(EN_QUERY_WORDS, 2)
+        return " ".join(words)
+
+    def run(self, op: str):
+        rng = random.Random(self._next_seed())
+        if op == "qa":
+            result = self.qa_chain({"query": self._query(rng), "language_mode": "zh"})
+            if not result.get("result"):
+                raise RuntimeError("qa 回傳空的答案")
+        elif op == "search":
+            self.rp.semantic_search(self.vector_store, self._query(rng), k=self.args.top_k)
+        elif op == "ingest":
+            text = self.make_corpus(self.args.ingest_chars, seed=100000 + self._next_seed())
+            docs = self.rp.build_docs_from_text(text, source_name="upload.txt")
+            store = self.rp.build_vector_store(docs)
+            self.rp.get_docs_stats_from_vector_store(store)
+
+    def child_pids(self) -> List[int]:
+        """
+        ProcessShard 子行程的 pid（記憶體取樣時一併計入）。
+        """
+        shards = getattr(self.vector_store, "shards", [])
+        return [s.process.pid for s in shards if isinstance(s, self.rp.ProcessShard)]
+
+    def close(self):
+        if hasattr(self.vector_store, "close"):
+            self.vector_store.close()
+
+
+def run_load(workloads: Workloads, mix: Dict[str, float], args) -> Recorder:
+    """
+    open-loop 送流量：依目標 QPS 排程，不等前一個請求完成；
+    延遲從「排定送出的時間」開始算，所以 worker 不夠用時的排隊時間也會反映在延遲上。
+    """
+    recorder = Recorder()
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    rng = random.Random(args.seed)
+    in_flight = [0]
+    in_flight_lock = threading.Lock()
+    stop = threading.Event()
+    child_pids = workloads.child_pids()
+    start = time.perf_counter()
+
+    def sampler():
+        while not stop.is_set():
+            recorder.sample_memory(time.perf_counter() - start, in_flight[0], child_pids)
+            stop.wait(args.sample_interval)
+
+    def task(op: str, scheduled: float):
+        error = None
+        try:
+            workloads.run(op)
+        except Exception as e:
+            error = e
+        recorder.record(op, time.perf_counter() - scheduled, error)
+        with in_flight_lock:
+            in_flight[0] -= 1
+
+    threading.Thread(target=sampler, daemon=True).start()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        next_time = start
+        while True:
+            now = time.perf_counter()
+            if now - start >= args.duration:
+                break
+            if now < next_time:
+                time.sleep(next_time - now)
+            with in_flight_lock:
+                if in_flight[0] >= args.max_in_flight:
+                    recorder.dropped += 1
+                    skip = True
+                else:
+                    in_flight[0] += 1
+                    skip = False
+            if not skip:
+                op = rng.choices(names, weights)[0]
+                pool.submit(task, op, next_time)
+            gap = rng.expovariate(args.qps) if args.poisson else 1.0 / args.qps
+            next_time += gap
+    stop.set()
+    recorder.sample_memory(time.perf_counter() - start, 0, child_pids)
+    recorder.wall_seconds = time.perf_counter() - start
+    return recorder
+
+
+def build_report(recorder: Recorder, workloads: Workloads, args, stub=None) -> Dict:
+    report = {
+        "config": {
+            "qps": args.qps,
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "mix": args.mix,
+            "shards": args.shards,
+            "stream": args.stream,
+            "max_retries": args.max_retries,
+            "chunks": workloads.num_chunks,
+            "index_build_seconds": round(workloads.build_seconds, 3),
+        },
+        "wall_seconds": round(recorder.wall_seconds, 2),
+        "dropped": recorder.dropped,
+        "ops": {},
+        "errors": recorder.error_messages,
+        "memory": recorder.memory,
+    }
+    all_latencies: List[float] = []
+    total_errors = 0
+    for op, latencies in sorted(recorder.samples.items()):
+        values = sorted(latencies)
+        all_latencies.extend(values)
+        errors = recorder.errors.get(op, 0)
+        total_errors += errors
+        report["ops"][op] = {
+            "count": len(values),
+            "throughput_rps": round(len(values) / recorder.wall_seconds, 2),
+            "error_rate": round(errors / len(values), 4),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p90_ms": round(percentile(values, 90) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+            "max_ms": round(values[-1] * 1000, 1),
+        }
+    all_latencies.sort()
+    n = len(all_latencies)
+    report["total"] = {
+        "count": n,
+        "throughput_rps": round(n / recorder.wall_seconds, 2),
+        "error_rate": round(total_errors / n, 4) if n else 0.0,
+        "p50_ms": round(percentile(all_latencies, 50) * 1000, 1),
+        "p90_ms": round(percentile(all_latencies, 90) * 1000, 1),
+        "p99_ms": round(percentile(all_latencies, 99) * 1000, 1),
+        "max_ms": round(all_latencies[-1] * 1000, 1) if n else 0.0,
+    }
+    if stub is not None:
+        report["stub_counters"] = dict(stub.counters)
+    return report
+
+
+def print_report(report: Dict):
+    cfg = report["config"]
+    print(
+        f"\n目標 {cfg['qps']} QPS × {cfg['duration']} 秒，mix={cfg['mix']}，"
+        f"concurrency={cfg['concurrency']}，shards={cfg['shards']}，chunks={cfg['chunks']}"
+    )
+    print(f"{'op':<8}{'count':>8}{'rps':>9}{'err%':>8}{'p50ms':>10}{'p90ms':>10}{'p99ms':>10}{'maxms':>10}")
+    rows = list(report["ops"].items()) + [("total", report["total"])]
+    for op, r in rows:
+        print(
+            f"{op:<8}{r['count']:>8}{r['throughput_rps']:>9}{r['error_rate'] * 100:>7.2f}%"
+            f"{r['p50_ms']:>10}{r['p90_ms']:>10}{r['p99_ms']:>10}{r['max_ms']:>10}"
+        )
+    if report["dropped"]:
+        print(f"因 in-flight 上限而未送出的請求：{report['dropped']}")
+    for key, count in report["errors"].items():
+        print(f"錯誤 {key} × {count}")
+    memory = report["memory"]
+    if memory:
+        step = max(1, len(memory) // 10)
+        timeline = ", ".join(f"{m['t']:.0f}s:{m['rss_mb']}MB" for m in memory[::step])
+        peak = max(m["rss_mb"] for m in memory)
+        child_peak = max(m.get("child_rss_mb", 0) for m in memory)
+        children = f"，其中分片子行程 {child_peak} MB" if child_peak else ""
+        print(f"記憶體 RSS（峰值 {peak} MB{children}）：{timeline}")
+    if "stub_counters" in report:
+        print(f"stub 收到的請求：{report['stub_counters']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="AskMyDocs concurrent load test")
+    parser.add_argument("--base-url", help="OpenAI 相容服務的網址；省略則在本 process 內啟動 stub")
+    parser.add_argument("--qps", type=float, default=10.0, help="目標每秒請求數")
+    parser.add_argument("--duration", type=float, default=30.0, help="測試秒數")
+    parser.add_argument("--concurrency", type=int, default=50, help="同時執行的 worker 數（模擬同時在問的人數）")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="排隊中的請求上限，超過就丟棄並計數")
+    parser.add_argument("--mix", default="qa=0.6,search=0.3,ingest=0.1")
+    parser.add_argument("--poisson", action="store_true", help="用 Poisson 到達（預設為固定間隔）")
+    parser.add_argument("--stream", action="store_true", help="qa 使用串流的 chat completions")
+    parser.add_argument(
+        "--max-retries", type=int, default=0,
+        help="embeddings / chat client 的自動重試次數（預設 0，錯誤率才會反映注入的錯誤）",
+    )
+    parser.add_argument(
+        "--no-tiktoken", action="store_true",
+        help="embeddings 不先用 tiktoken 斷詞（使用內建 stub 時自動開啟，可離線執行）",
+    )
+    parser.add_argument("--corpus-chars", type=int, default=500_000, help="初始向量庫的總字元數")
+    parser.add_argument("--sources", type=int, default=10, help="初始向量庫的檔案數")
+    parser.add_argument("--ingest-chars", type=int, default=20_000, help="每次 ingest 的文件大小")
+    parser.add_argument("--top-k", type=int, default=4)
+    parser.add_argument("--shards", type=int, default=1, help=">1 時使用 ShardedVectorStore")
+    parser.add_argument("--shard-mode", default="local", choices=["local", "process"])
+    parser.add_argument("--shard-by", default="source", choices=["source", "hash"])
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="記憶體取樣間隔（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="把完整報告（含記憶體時間序列）寫成 JSON")
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    from rag_pipeline import EMBEDDING_CHECK_CTX_ENV, EMBEDDING_MAX_RETRIES_ENV
+
+    stub = None
+    if args.base_url:
+        os.environ["OPENAI_BASE_URL"] = args.base_url
+    else:
+        stub = start_stub_server(config=config_from_args(args))
+        os.environ["OPENAI_BASE_URL"] = stub.base_url
+        print(f"已啟動 stub server：{stub.base_url}")
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    # 設在環境變數裡，ProcessShard 子行程建立的 embeddings client 也會套用
+    os.environ[EMBEDDING_MAX_RETRIES_ENV] = str(args.max_retries)
+    if stub is not None or args.no_tiktoken:
+        os.environ[EMBEDDING_CHECK_CTX_ENV] = "0"
+
+    workloads = Workloads(args)
+    try:
+        recorder = run_load(workloads, mix, args)
+    finally:
+        workloads.close()
+    report = build_report(recorder, workloads, args, stub)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"完整報告已寫入 {args.json}")
+    if stub is not None:
+        stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,214 @@
 # rag_pipeline.py
+#
+# langchain / langchain_openai / FAISS 都很重（import 要好幾秒），
+# 而 Streamlit 每次互動都會重跑 app.py，所以這裡只在型別註記用到它們，
+# 真正的 import 延後到第一次呼叫時才做（見各函式內的 local import）。
+
+from __future__ import annotations
+
+import hashlib
+import heapq
+import json
+import os
+import queue
+import threading
+import time
+import weakref
+from array import array
+from collections import ChainMap
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from typing import TYPE_CHECKING, List, Dict, Tuple, Optional
+
+if TYPE_CHECKING:
+    from langchain_community.vectorstores import FAISS
+    from langchain_openai import OpenAIEmbeddings
+    from langchain_core.documents import Document
+
+
+# ========= 文字切塊（單次掃描，回傳 offsets） =========
+
+# 與原本 RecursiveCharacterTextSplitter 相同的設定
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 200
+CHUNK_SEPARATORS = ["\n\n", "\n", "。", "！", "？", " ", ""]
+
+
+def _scan_separator_positions(
+    text: str, separators: List[str]
+) -> Dict[str, List[int]]:
+    """
+    找出所有分隔符在全文中的位置：{分隔符: [起點, ...]}（已排序）。
+    單字元分隔符合成一個字元集合一次掃完；多字元分隔符各自用 re.finditer 掃，
+    位置才會與 re.split 的非重疊 match 完全一致
+    （分隔符之間共用字元時，例如 "ab" 與 "aa"，合成一個 alternation 會互相吃掉 match）。
+    """
+    import re
+
+    seps = [s for s in dict.fromkeys(separators) if s]
+    positions: Dict[str, List[int]] = {s: [] for s in seps}
+    singles = [s for s in seps if len(s) == 1]
+    if singles:
+        pattern = re.compile("[" + "".join(re.escape(s) for s in singles) + "]")
+        for m in pattern.finditer(text):
+            positions[m.group()].append(m.start())
+    for sep in seps:
+        if len(sep) > 1:
+            positions[sep] = [m.start() for m in re.finditer(re.escape(sep), text)]
+    return positions
+
+
+def split_text_offsets(
+    text: str,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    separators: Optional[List[str]] = None,
+) -> List[Tuple[int, int]]:
+    """
+    與 RecursiveCharacterTextSplitter(keep_separator=True, strip_whitespace=True)
+    切出完全相同的 chunk，但只回傳 (start, end) offsets：text[start:end] 就是 chunk。
+    - 分隔符位置在開頭掃描一次，之後每一層遞迴都用 bisect 在位置表裡查區間，
+      不再反覆 re.split / 字串串接；只有多字元分隔符（預設只有 "\\n\\n"）
+      在子區間內會用 finditer(text, pos, endpos) 重掃該區間。
+    - 過程中只產生 offsets，不會複製任何子字串（最後由呼叫端用 offsets 切出 chunk）。
+    參數檢查與 RecursiveCharacterTextSplitter 相同，不合法時丟出 ValueError。
+    """
+    from bisect import bisect_left
+
+    if chunk_size <= 0:
+        raise ValueError(f"chunk_size must be > 0, got {chunk_size}")
+    if chunk_overlap < 0:
+        raise ValueError(f"chunk_overlap must be >= 0, got {chunk_overlap}")
+    if chunk_overlap > chunk_size:
+        raise ValueError(
+            f"Got a larger chunk overlap ({chunk_overlap}) than chunk size "
+            f"({chunk_size}), should be smaller."
+        )
+
+    separators = list(separators or CHUNK_SEPARATORS)
+    positions = _scan_separator_positions(text, separators)
+    patterns: Dict[str, object] = {}
+    n_text = len(text)
+    out: List[Tuple[int, int]] = []
+
+    def emit(s: int, e: int):
+        # 等同 _join_docs 的 strip()：頭尾空白不算進 chunk，全空白就丟掉
+        while s < e and text[s].isspace():
+            s += 1
+        while e > s and text[e - 1].isspace():
+            e -= 1
+        if s < e:
+            out.append((s, e))
+
+    def merge(pieces: List[Tuple[int, int]]):
+        # 等同 _merge_splits（keep_separator 時分隔符長度為 0）；
+        # pieces[head:i] 就是目前累積中的 chunk，不另外建 list
+        head = 0
+        total = 0
+        for i, (s, e) in enumerate(pieces):
+            length = e - s
+            if total + length > chunk_size and head < i:
+                emit(pieces[head][0], pieces[i - 1][1])
+                while total > chunk_overlap or (
+                    total + length > chunk_size and total > 0
+                ):
+                    total -= pieces[head][1] - pieces[head][0]
+                    head += 1
+            total += length
+        if head < len(pieces):
+            emit(pieces[head][0], pieces[-1][1])
+
+    def merge_chars(a: int, b: int):
+        # 最後一層（""）每個字元各自一塊、長度都是 1，merge 的結果就是
+        # 每次前進 chunk_size - chunk_overlap 的固定視窗，直接算出來
+        # （overlap == chunk_size 時 merge 每次只丟掉一個字元，所以至少前進 1）
+        step = max(1, chunk_size - chunk_overlap)
+        start = a
+        while b - start > chunk_size:
+            emit(start, start + chunk_size)
+            start += step
+        emit(start, b)
+
+    def find_in_range(sep: str, a: int, b: int) -> List[int]:
+        if len(sep) > 1 and (a, b) != (0, n_text):
+            # 多字元分隔符在子區間內的非重疊 match 可能與全文不同，保守起見重掃這一段；
+            # 用 pos / endpos 直接在原字串上掃，match 不會超出 b，也不用切出子字串
+            pattern = patterns.get(sep)
+            if pattern is None:
+                import re
+
+                pattern = patterns[sep] = re.compile(re.escape(sep))
+            return [m.start() for m in pattern.finditer(text, a, b)]
+        pos = positions[sep]
+        lo = bisect_left(pos, a)
+        hi = bisect_left(pos, b - len(sep) + 1, lo)
+        return pos[lo:hi]
+
+    def split_range(a: int, b: int, level: int):
+        sep = separators[-1]
+        next_level = len(separators)
+        matches: List[int] = []
+        for i in range(level, len(separators)):
+            candidate = separators[i]
+            if not candidate:
+                sep = candidate
+                break
+            found = find_in_range(candidate, a, b)
+            if found:
+                sep = candidate
+                matches = found
+                next_level = i + 1
+                break
+
+        if not sep:
+            if chunk_size > 1:
+                merge_chars(a, b)
+                return
+            pieces = [(j, j + 1) for j in range(a, b)]
+        else:
+            if not matches:
+                matches = find_in_range(sep, a, b)
+            bounds = [a] + matches + [b]
+            pieces = [
+                (bounds[j], bounds[j + 1])
+                for j in range(len(bounds) - 1)
+                if bounds[j] < bounds[j + 1]
+            ]
+
+        good: List[Tuple[int, int]] = []
+        for s, e in pieces:
+            if e - s < chunk_size:
+                good.append((s, e))
+                continue
+            if good:
+                merge(good)
+                good = []
+            if next_level >= len(separators):
+                out.append((s, e))
+            else:
+                split_range(s, e, next_level)
+        if good:
+            merge(good)
+
+    if text:
+        split_range(0, n_text, 0)
+    return out
 
-from typing import List, Dict, Tuple
 
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_core.documents import Document
+def split_text_fast(
+    text: str,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    separators: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    split_text_offsets 的字串版本，輸出與 RecursiveCharacterTextSplitter.split_text 相同。
+    """
+    return [
+        text[s:e]
+        for s, e in split_text_offsets(text, chunk_size, chunk_overlap, separators)
+    ]
 
 
 # ========= 文件處理 =========
@@ -14,52 +217,309 @@ def build_docs_from_text(text: str, source_name: str = "upload") -> List[Documen
     """
     把一大段文字切成多個 Document chunk，給後面做 embedding 用。
     source_name 會放在 metadata["source"]，方便之後顯示來源檔案。
+    切塊用 split_text_offsets（結果與 RecursiveCharacterTextSplitter 相同，但快很多）。
     """
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=800,
-        chunk_overlap=200,
-        separators=["\n\n", "\n", "。", "！", "？", " ", ""],
-    )
-    chunks = splitter.split_text(text)
+    from langchain_core.documents import Document
+
     docs = [
-        Document(page_content=chunk, metadata={"source": source_name, "chunk_id": i})
-        for i, chunk in enumerate(chunks)
+        Document(page_content=text[s:e], metadata={"source": source_name, "chunk_id": i})
+        for i, (s, e) in enumerate(split_text_offsets(text))
     ]
     return docs
 
 
+# 壓力測試用：環境變數會一起傳到分片子行程，所以用環境變數而不是參數
+EMBEDDING_MAX_RETRIES_ENV = "ASKMYDOCS_EMBEDDING_MAX_RETRIES"
+EMBEDDING_CHECK_CTX_ENV = "ASKMYDOCS_EMBEDDING_CHECK_CTX"
+
+
+def get_embeddings() -> OpenAIEmbeddings:
+    """
+    統一建立 embedding 模型（建庫、載入、分片 worker 共用）。
+    ASKMYDOCS_EMBEDDING_MAX_RETRIES：覆寫 client 的重試次數。
+    ASKMYDOCS_EMBEDDING_CHECK_CTX=0：不先用 tiktoken 斷詞（直接送字串，離線的 stub 可用）。
+    """
+    from langchain_openai import OpenAIEmbeddings
+
+    kwargs = {}
+    max_retries = os.environ.get(EMBEDDING_MAX_RETRIES_ENV)
+    if max_retries:
+        kwargs["max_retries"] = int(max_retries)
+    if os.environ.get(EMBEDDING_CHECK_CTX_ENV, "1") == "0":
+        kwargs["check_embedding_ctx_length"] = False
+    return OpenAIEmbeddings(model="text-embedding-3-small", **kwargs)
+
+
 def build_vector_store(docs: List[Document]) -> FAISS:
     """
-    建立向量資料庫（FAISS）
+    建立向量資料庫（FAISS），chunk 存在 CompactDocstore 裡。
     """
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-    vector_store = FAISS.from_documents(docs, embeddings)
+    from langchain_community.vectorstores import FAISS
+
+    embeddings = get_embeddings()
+    vector_store = FAISS.from_documents(docs, embeddings, docstore=CompactDocstore())
     return vector_store
 
 
-def save_vector_store(vector_store: FAISS, path: str = "faiss_db"):
+# 版本化快照目錄結構：
+#   faiss_db/
+#     CURRENT                 <- 內容是目前版本 id，用 os.replace 原子切換
+#     versions/<version_id>/  <- 每次儲存都是全新的資料夾，寫完 fsync 後才發佈
+SNAPSHOT_POINTER = "CURRENT"
+SNAPSHOT_VERSIONS_DIR = "versions"
+SNAPSHOT_KEEP = 3
+DOC_SUMMARIES_FILE = "doc_summaries.json"
+_STALE_TMP_SECONDS = 3600
+_LOAD_RETRIES = 3
+_PUBLISH_LOCK_FILE = ".publish.lock"
+
+
+def _fsync_path(path: str):
+    """
+    把檔案或資料夾的內容強制寫到磁碟（Windows 不支援對資料夾 fsync，直接略過）。
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _fsync_tree(root: str):
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            _fsync_path(os.path.join(dirpath, name))
+        _fsync_path(dirpath)
+
+
+def _new_version_id() -> str:
     """
-    把向量庫存到本地資料夾（持久化）
+    版本 id：時間（可排序）+ 隨機字串（兩個 writer 同時存也不會撞名）。
     """
-    import os
+    import uuid
 
-    os.makedirs(path, exist_ok=True)
-    vector_store.save_local(path)
+    return time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() % 10**9:09d}-{uuid.uuid4().hex[:6]}"
 
 
-def load_vector_store(path: str = "faiss_db") -> FAISS:
+def get_current_version(path: str = "faiss_db") -> Optional[str]:
     """
-    從本地資料夾載入向量庫。
+    讀取目前發佈中的版本 id；舊格式（沒有 CURRENT）或尚未存過則回傳 None。
+    """
+    try:
+        with open(os.path.join(path, SNAPSHOT_POINTER), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def list_versions(path: str = "faiss_db") -> List[str]:
+    """
+    列出所有已發佈的版本（由舊到新），不含寫到一半的暫存資料夾。
+    """
+    versions_dir = os.path.join(path, SNAPSHOT_VERSIONS_DIR)
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted(v for v in os.listdir(versions_dir) if not v.startswith("."))
+
+
+def _resolve_snapshot_dir(path: str, version: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    """
+    回傳 (實際要讀的資料夾, 版本 id)；沒有 CURRENT 時視為舊格式，直接讀 path 本身。
+    """
+    version = version or get_current_version(path)
+    if version is None:
+        return path, None
+    return os.path.join(path, SNAPSHOT_VERSIONS_DIR, version), version
+
+
+def has_snapshot(path: str) -> bool:
     """
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+    path 底下是否有可載入的向量庫（新版快照或舊格式都算）。
+    """
+    snapshot_dir, _ = _resolve_snapshot_dir(path)
+    return any(
+        os.path.exists(os.path.join(snapshot_dir, name))
+        for name in ("index.faiss", SHARD_MANIFEST)
+    )
+
+
+class _PublishLock:
+    """
+    跨 process / thread 的發佈鎖（path/.publish.lock 上的檔案鎖）。
+    rename → 切換 CURRENT → 清舊版本 必須整段互斥：否則慢的 writer 剛 rename 好的版本
+    可能被快的 writer 當成舊版本清掉，接著它又把 CURRENT 指到這個已刪除的資料夾。
+    """
+
+    def __init__(self, path: str):
+        self.lock_path = os.path.join(path, _PUBLISH_LOCK_FILE)
+        self._fd: Optional[int] = None
+
+    def __enter__(self):
+        self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            import fcntl
+
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except ImportError:
+            import msvcrt
+
+            while True:
+                try:
+                    msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            import fcntl
+
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except ImportError:
+            import msvcrt
+
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _prune_versions(path: str, keep: int):
+    """
+    只保留最新的 keep 個版本（目前版本一定保留），並清掉很久以前寫到一半的暫存資料夾。
+    已經載入記憶體的 reader 不受影響；正在載入舊版本的 reader 會在 load_vector_store 內重試。
+    呼叫端須持有 _PublishLock。清理是盡力而為：其他 writer 同時在 rename 自己的暫存資料夾，
+    檔案隨時可能消失，這裡不會丟出例外。
+    """
+    import shutil
+
+    versions_dir = os.path.join(path, SNAPSHOT_VERSIONS_DIR)
+    current = get_current_version(path)
+    versions = list_versions(path)
+    for v in versions[: max(0, len(versions) - keep)]:
+        if v != current:
+            shutil.rmtree(os.path.join(versions_dir, v), ignore_errors=True)
+    now = time.time()
+    try:
+        names = os.listdir(versions_dir)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.startswith(".tmp-"):
+            continue
+        full = os.path.join(versions_dir, name)
+        try:
+            stale = now - os.path.getmtime(full) > _STALE_TMP_SECONDS
+        except FileNotFoundError:
+            continue
+        if stale:
+            shutil.rmtree(full, ignore_errors=True)
+
+
+def save_vector_store(
+    vector_store: FAISS,
+    path: str = "faiss_db",
+    keep: int = SNAPSHOT_KEEP,
+    doc_summaries: Optional[Dict[str, str]] = None,
+) -> str:
+    """
+    把向量庫存成一個新版本並原子發佈，回傳版本 id。
+    doc_summaries 會一起寫進同一個版本（doc_summaries.json），之後用 load_doc_summaries 讀回。
+    流程：寫入 versions/.tmp-<id> → fsync → rename 成 versions/<id> → 原子替換 CURRENT。
+    寫入暫存資料夾可以多個 writer 同時進行；rename 之後的發佈步驟由 _PublishLock 串行化。
+    讀取端不需要任何鎖：它們要嘛看到舊版本、要嘛看到完整的新版本。
+    """
+    versions_dir = os.path.join(path, SNAPSHOT_VERSIONS_DIR)
+    os.makedirs(versions_dir, exist_ok=True)
+
+    version = _new_version_id()
+    tmp_dir = os.path.join(versions_dir, f".tmp-{version}")
+    final_dir = os.path.join(versions_dir, version)
+    vector_store.save_local(tmp_dir)
+    if doc_summaries is not None:
+        with open(os.path.join(tmp_dir, DOC_SUMMARIES_FILE), "w", encoding="utf-8") as f:
+            json.dump(doc_summaries, f, ensure_ascii=False)
+    _fsync_tree(tmp_dir)
+
+    with _PublishLock(path):
+        os.rename(tmp_dir, final_dir)
+        _fsync_path(versions_dir)
+
+        pointer_tmp = os.path.join(path, f".{SNAPSHOT_POINTER}.{version}")
+        with open(pointer_tmp, "w", encoding="utf-8") as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer_tmp, os.path.join(path, SNAPSHOT_POINTER))
+        _fsync_path(path)
+
+        try:
+            _prune_versions(path, keep)
+        except OSError:
+            pass  # 新版本已經發佈成功，清不掉的舊版本留給下一次儲存
+    return version
+
+
+def _load_snapshot_dir(snapshot_dir: str):
+    if os.path.exists(os.path.join(snapshot_dir, SHARD_MANIFEST)):
+        return load_sharded_vector_store(snapshot_dir)
+    from langchain_community.vectorstores import FAISS
+
+    embeddings = get_embeddings()
     vector_store = FAISS.load_local(
-        path,
+        snapshot_dir,
         embeddings,
         allow_dangerous_deserialization=True,
     )
+    # 舊版存檔是 InMemoryDocstore，載入後轉成 CompactDocstore
+    return compact_vector_store(vector_store)
+
+
+def load_vector_store(path: str = "faiss_db", version: Optional[str] = None) -> FAISS:
+    """
+    從本地資料夾載入向量庫（預設為 CURRENT 指向的版本，也可指定 version）。
+    若快照內有分片 manifest（shards.json），則載入為 ShardedVectorStore。
+    回傳的物件帶有 snapshot_version 屬性，可當作下游快取的失效鍵。
+    """
+    snapshot_dir, resolved = _resolve_snapshot_dir(path, version)
+    for _ in range(_LOAD_RETRIES):
+        try:
+            vector_store = _load_snapshot_dir(snapshot_dir)
+            break
+        except (FileNotFoundError, RuntimeError):
+            # 讀到一半，該版本被 retention 清掉了（期間有新版本發佈）：
+            # 重新讀 CURRENT，版本有變就改讀新版本，沒變代表真的壞了，直接丟出
+            if version is not None:
+                raise
+            retry_dir, retry_version = _resolve_snapshot_dir(path)
+            if retry_version == resolved:
+                raise
+            snapshot_dir, resolved = retry_dir, retry_version
+    else:
+        vector_store = _load_snapshot_dir(snapshot_dir)
+    vector_store.snapshot_version = resolved
     return vector_store
 
 
+def load_doc_summaries(path: str = "faiss_db", version: Optional[str] = None) -> Dict[str, str]:
+    """
+    讀取和向量庫快照一起存下的文件摘要；沒有就回傳空 dict。
+    """
+    snapshot_dir, _ = _resolve_snapshot_dir(path, version)
+    try:
+        with open(os.path.join(snapshot_dir, DOC_SUMMARIES_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
 def get_all_docs_from_vector_store(vector_store: FAISS):
     """
     取得向量庫裡所有 Document。
@@ -72,7 +532,11 @@ def get_all_docs_from_vector_store(vector_store: FAISS):
 def get_docs_stats_from_vector_store(vector_store: FAISS) -> Dict:
     """
     向量庫中文件統計資訊。
+    CompactDocstore / 分片向量庫直接用欄位資料算，不建立 Document。
     """
+    docstore = getattr(vector_store, "docstore", None)
+    if hasattr(docstore, "stats"):
+        return docstore.stats()
     docs = list(get_all_docs_from_vector_store(vector_store))
     total_docs = len(docs)
     total_chars = sum(len(d.page_content) for d in docs)
@@ -94,6 +558,8 @@ def get_source_names(vector_store: FAISS) -> List[str]:
     """
     取得目前向量庫中所有來源檔名。
     """
+    if hasattr(getattr(vector_store, "docstore", None), "stats"):
+        return sorted(vector_store.docstore.stats()["per_source"])
     docs = get_all_docs_from_vector_store(vector_store)
     names = sorted({d.metadata.get("source", "unknown") for d in docs})
     return names
@@ -111,6 +577,1611 @@ def group_docs_by_source(vector_store: FAISS) -> Dict[str, List[Document]]:
     return groups
 
 
+def get_source_texts(vector_store: FAISS, source: str) -> List[str]:
+    """
+    取得某個來源檔案所有 chunk 的文字（依 chunk 順序）。
+    CompactDocstore 直接從文字 buffer 切出來，不用把整個向量庫分組。
+    """
+    docstore = getattr(vector_store, "docstore", None)
+    if hasattr(docstore, "texts_for_source"):
+        return docstore.texts_for_source(source)
+    return [d.page_content for d in group_docs_by_source(vector_store).get(source, [])]
+
+
+# ========= 精簡欄位式 Docstore（Compact Chunk Store） =========
+
+_DOCSTORE_ABCS_REGISTERED = False
+_NO_CHUNK_ID = -(2**63)
+# 每個 chunk 各自挑較省空間的編碼：英文為主用 UTF-8（1 byte/字），中文為主用 UTF-16（2 bytes/字）
+_CODECS = ("utf-8", "utf-16-le")
+# 已刪除的 row 超過這個比例就重建 buffer，把空間真的還回去（攤提後每次刪除仍是 O(1)）
+_COMPACT_DELETED_RATIO = 0.25
+
+
+def _register_docstore_abcs():
+    """
+    把 CompactDocstore 註冊成 langchain Docstore / AddableMixin 的虛擬子類別，
+    FAISS 內部的 isinstance 檢查才會通過；用註冊而不繼承，是為了不在 import 時載入 langchain。
+    """
+    global _DOCSTORE_ABCS_REGISTERED
+    if _DOCSTORE_ABCS_REGISTERED:
+        return
+    from langchain_community.docstore.base import AddableMixin, Docstore
+
+    Docstore.register(CompactDocstore)
+    AddableMixin.register(CompactDocstore)
+    _DOCSTORE_ABCS_REGISTERED = True
+
+
+class _CompactDocMap(Mapping):
+    """
+    CompactDocstore._dict 的唯讀檢視：只有真的取值時才建立 Document。
+    讓 get_all_docs_from_vector_store 這類讀 docstore._dict 的程式不用改。
+    """
+
+    def __init__(self, store: "CompactDocstore"):
+        self._store = store
+
+    def __getitem__(self, doc_id: str) -> Document:
+        row = self._store._id_to_row[doc_id]
+        return self._store._materialize(row)
+
+    def __iter__(self):
+        return iter(list(self._store._id_to_row))
+
+    def __len__(self) -> int:
+        return len(self._store._id_to_row)
+
+    def __contains__(self, doc_id) -> bool:
+        return doc_id in self._store._id_to_row
+
+
+class CompactDocstore:
+    """
+    取代 InMemoryDocstore 的精簡 chunk 儲存：
+    - 所有 chunk 文字串在一個 bytearray 裡，用 offsets 陣列切開；
+      每個 chunk 依內容選 UTF-8 或 UTF-16，不會比 Python str 本身佔更多空間
+    - source 存成整數代碼，chunk_id / 字元數都是 array，不再每個 chunk 一個 dict
+    - 只有 search() 回傳給呼叫端的結果才會臨時建立 Document
+    - 統計（總字元數、各 source chunk 數）用 numpy 一次算完
+    其他 metadata 欄位（很少見）才另外存成 {row: dict}。
+    """
+
+    def __init__(self):
+        _register_docstore_abcs()
+        self._text = bytearray()
+        self._offsets = array("q", [0])
+        self._char_lens = array("i")
+        self._codecs = array("b")
+        self._source_codes = array("i")
+        self._chunk_ids = array("q")
+        self._source_names: List = []
+        self._source_index: Dict = {}
+        self._extra: Dict[int, dict] = {}
+        self._row_ids: List[str] = []
+        self._id_to_row: Dict[str, int] = {}
+        self._deleted: set = set()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        _register_docstore_abcs()
+
+    @classmethod
+    def from_documents(cls, docs: Dict[str, Document]) -> "CompactDocstore":
+        store = cls()
+        store.add(docs)
+        return store
+
+    @property
+    def _dict(self) -> _CompactDocMap:
+        return _CompactDocMap(self)
+
+    def __len__(self) -> int:
+        return len(self._id_to_row)
+
+    def _source_code(self, source) -> int:
+        code = self._source_index.get(source)
+        if code is None:
+            code = len(self._source_names)
+            self._source_names.append(source)
+            self._source_index[source] = code
+        return code
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        overlapping = set(texts).intersection(self._id_to_row)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        for doc_id, doc in texts.items():
+            row = len(self._row_ids)
+            text = doc.page_content
+            data = text.encode("utf-8")
+            codec = 0
+            if len(data) > 2 * len(text):
+                data = text.encode("utf-16-le")
+                codec = 1
+            self._text += data
+            self._codecs.append(codec)
+            self._offsets.append(len(self._text))
+            self._char_lens.append(len(doc.page_content))
+
+            meta = doc.metadata or {}
+            source = meta.get("source")
+            self._source_codes.append(-1 if source is None else self._source_code(source))
+            chunk_id = meta.get("chunk_id")
+            if isinstance(chunk_id, int) and not isinstance(chunk_id, bool):
+                self._chunk_ids.append(chunk_id)
+                extra = {k: v for k, v in meta.items() if k not in ("source", "chunk_id")}
+            else:
+                self._chunk_ids.append(_NO_CHUNK_ID)
+                extra = {k: v for k, v in meta.items() if k != "source"}
+            if extra:
+                self._extra[row] = extra
+
+            self._row_ids.append(doc_id)
+            self._id_to_row[doc_id] = row
+
+    def delete(self, ids: List) -> None:
+        overlapping = set(ids).intersection(self._id_to_row)
+        if not overlapping:
+            raise ValueError(f"Tried to delete ids that does not  exist: {ids}")
+        for doc_id in ids:
+            row = self._id_to_row.pop(doc_id)
+            self._deleted.add(row)
+            self._extra.pop(row, None)
+        if len(self._deleted) >= _COMPACT_DELETED_RATIO * len(self._row_ids):
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        回收已刪除 chunk 佔的空間：依原順序重建文字 buffer 與各欄位陣列、重新編號 row，
+        不再被任何 chunk 使用的 source 也一併移除。
+        """
+        if not self._deleted:
+            return
+        text = bytearray()
+        offsets = array("q", [0])
+        char_lens = array("i")
+        codecs = array("b")
+        source_codes = array("i")
+        chunk_ids = array("q")
+        source_names: List = []
+        source_index: Dict = {}
+        code_map: Dict[int, int] = {}
+        extra: Dict[int, dict] = {}
+        row_ids: List[str] = []
+        id_to_row: Dict[str, int] = {}
+
+        buf = memoryview(self._text)
+        for row, doc_id in enumerate(self._row_ids):
+            if row in self._deleted:
+                continue
+            new_row = len(row_ids)
+            text += buf[self._offsets[row] : self._offsets[row + 1]]
+            offsets.append(len(text))
+            char_lens.append(self._char_lens[row])
+            codecs.append(self._codecs[row])
+            code = self._source_codes[row]
+            if code >= 0:
+                new_code = code_map.get(code)
+                if new_code is None:
+                    new_code = code_map[code] = len(source_names)
+                    source_names.append(self._source_names[code])
+                    source_index[self._source_names[code]] = new_code
+                code = new_code
+            source_codes.append(code)
+            chunk_ids.append(self._chunk_ids[row])
+            if row in self._extra:
+                extra[new_row] = self._extra[row]
+            row_ids.append(doc_id)
+            id_to_row[doc_id] = new_row
+        buf.release()
+
+        self._text = text
+        self._offsets = offsets
+        self._char_lens = char_lens
+        self._codecs = codecs
+        self._source_codes = source_codes
+        self._chunk_ids = chunk_ids
+        self._source_names = source_names
+        self._source_index = source_index
+        self._extra = extra
+        self._row_ids = row_ids
+        self._id_to_row = id_to_row
+        self._deleted = set()
+
+    def search(self, search: str):
+        row = self._id_to_row.get(search)
+        if row is None:
+            return f"ID {search} not found."
+        return self._materialize(row)
+
+    def _text_at(self, row: int) -> str:
+        data = self._text[self._offsets[row] : self._offsets[row + 1]]
+        return data.decode(_CODECS[self._codecs[row]])
+
+    def _metadata_at(self, row: int) -> dict:
+        meta = {}
+        code = self._source_codes[row]
+        if code >= 0:
+            meta["source"] = self._source_names[code]
+        chunk_id = self._chunk_ids[row]
+        if chunk_id != _NO_CHUNK_ID:
+            meta["chunk_id"] = chunk_id
+        extra = self._extra.get(row)
+        if extra:
+            meta.update(extra)
+        return meta
+
+    def _materialize(self, row: int) -> Document:
+        from langchain_core.documents import Document
+
+        return Document(
+            id=self._row_ids[row],
+            page_content=self._text_at(row),
+            metadata=self._metadata_at(row),
+        )
+
+    def _alive_rows(self):
+        import numpy as np
+
+        n = len(self._row_ids)
+        if not self._deleted:
+            return None
+        mask = np.ones(n, dtype=bool)
+        mask[list(self._deleted)] = False
+        return mask
+
+    def _columns(self):
+        """
+        回傳（已排除刪除列的）(字元數, source 代碼) 兩個 numpy 陣列。
+        用 np.array 複製而不是 frombuffer，避免 array 之後 append 時遇到 BufferError。
+        """
+        import numpy as np
+
+        char_lens = np.array(self._char_lens, dtype=np.int64)
+        codes = np.array(self._source_codes, dtype=np.int64)
+        mask = self._alive_rows()
+        if mask is not None:
+            char_lens = char_lens[mask]
+            codes = codes[mask]
+        return char_lens, codes
+
+    def stats(self) -> Dict:
+        """
+        與 get_docs_stats_from_vector_store 相同格式，但不建立任何 Document。
+        """
+        import numpy as np
+
+        char_lens, codes = self._columns()
+        total_docs = int(len(char_lens))
+        total_chars = int(char_lens.sum())
+        avg_chars = total_docs and total_chars / total_docs or 0
+        counts = np.bincount(codes + 1, minlength=len(self._source_names) + 1)
+        per_source: Dict[str, int] = {}
+        for code in np.flatnonzero(counts):
+            src = "unknown" if code == 0 else self._source_names[code - 1]
+            per_source[src] = per_source.get(src, 0) + int(counts[code])
+        return {
+            "num_docs": total_docs,
+            "total_chars": total_chars,
+            "avg_chars": avg_chars,
+            "per_source": per_source,
+        }
+
+    def rows_for_source(self, source) -> List[int]:
+        import numpy as np
+
+        code = self._source_index.get(source)
+        if code is None and source != "unknown":
+            return []
+        codes = np.array(self._source_codes, dtype=np.int64)
+        hit = codes == (-1 if code is None else code)
+        if source == "unknown" and code is not None:
+            hit |= codes == -1
+        mask = self._alive_rows()
+        if mask is not None:
+            hit &= mask
+        return [int(r) for r in np.flatnonzero(hit)]
+
+    def texts_for_source(self, source) -> List[str]:
+        """
+        依原本加入的順序回傳某個 source 的所有 chunk 文字（不建立 Document）。
+        """
+        return [self._text_at(r) for r in self.rows_for_source(source)]
+
+    def memory_bytes(self) -> int:
+        """
+        粗估佔用的記憶體（不含 FAISS 向量本身），包含 source 名稱表與額外 metadata。
+        """
+        import sys
+
+        arrays = (
+            self._offsets,
+            self._char_lens,
+            self._codecs,
+            self._source_codes,
+            self._chunk_ids,
+        )
+        extra_bytes = sys.getsizeof(self._extra) + sum(
+            sys.getsizeof(meta)
+            + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in meta.items())
+            for meta in self._extra.values()
+        )
+        source_bytes = (
+            sys.getsizeof(self._source_names)
+            + sum(sys.getsizeof(name) for name in self._source_names)
+            + sys.getsizeof(self._source_index)
+        )
+        return (
+            len(self._text)
+            + sum(a.itemsize * len(a) for a in arrays)
+            + sys.getsizeof(self._id_to_row)
+            + sum(sys.getsizeof(i) for i in self._row_ids)
+            + sys.getsizeof(self._row_ids)
+            + sys.getsizeof(self._deleted)
+            + extra_bytes
+            + source_bytes
+        )
+
+
+def compact_vector_store(vector_store):
+    """
+    把 FAISS 的 InMemoryDocstore 換成 CompactDocstore（原地轉換，回傳同一個物件）。
+    已經是 CompactDocstore 或是分片向量庫時不做任何事。
+    """
+    docstore = getattr(vector_store, "docstore", None)
+    if isinstance(docstore, (CompactDocstore, _ShardedDocstore)) or docstore is None:
+        return vector_store
+    if hasattr(docstore, "_dict"):
+        vector_store.docstore = CompactDocstore.from_documents(docstore._dict)
+    return vector_store
+
+
+# ========= 冷啟動：延遲載入、預先載入與共用快取 =========
+
+# 以本模組被 import 的時間當作「開機」時間點，app 可用 mark_timing 記錄各階段。
+_BOOT_TIME = time.perf_counter()
+TIMINGS: Dict[str, float] = {}
+
+# 同一個 server process 內所有 session 共用的向量庫快取：{abspath: (signature, store)}
+_STORE_CACHE: Dict[str, Tuple[tuple, object]] = {}
+# _STORE_CACHE_LOCK 只保護 dict 的讀寫；真正從磁碟載入時改持有該 path 自己的載入鎖，
+# 所以預先載入 A 的時候，查快取、載入其他 path 都不會被擋住。
+_STORE_CACHE_LOCK = threading.Lock()
+_STORE_LOAD_LOCKS: Dict[str, threading.Lock] = {}
+_PRELOAD_THREADS: Dict[str, threading.Thread] = {}
+
+PRELOAD_ENV = "ASKMYDOCS_PRELOAD_PATH"
+
+
+def mark_timing(name: str) -> float:
+    """
+    記錄從開機到現在的秒數（同名只記第一次），例如 first_paint / first_query。
+    """
+    return TIMINGS.setdefault(name, time.perf_counter() - _BOOT_TIME)
+
+
+def get_timings() -> Dict[str, float]:
+    return dict(TIMINGS)
+
+
+def warm_imports():
+    """
+    先把 langchain / FAISS 等重型模組 import 進來，讓第一次查詢不用再等。
+    """
+    start = time.perf_counter()
+    import langchain_community.vectorstores  # noqa: F401
+    import langchain_openai  # noqa: F401
+    import langchain_text_splitters  # noqa: F401
+
+    TIMINGS.setdefault("heavy_imports", time.perf_counter() - start)
+
+
+def _snapshot_signature(path: str) -> tuple:
+    """
+    快取失效的依據：新版快照直接用版本 id；舊格式則用索引檔的 mtime / 大小。
+    """
+    version = get_current_version(path)
+    if version is not None:
+        return ("version", version)
+    sig = []
+    for name in ("index.faiss", "index.pkl", SHARD_MANIFEST):
+        fp = os.path.join(path, name)
+        if os.path.exists(fp):
+            st = os.stat(fp)
+            sig.append((name, st.st_mtime_ns, st.st_size))
+    return tuple(sig)
+
+
+def get_cached_vector_store(path: str = "faiss_db"):
+    """
+    從共用快取取得向量庫；第一次（或磁碟內容改變後）才真的 load_vector_store。
+    取得的向量庫會被多個 session 共用，呼叫端只能讀取、不要修改它。
+    """
+    key = os.path.abspath(path)
+    sig = _snapshot_signature(path)
+    with _STORE_CACHE_LOCK:
+        cached = _STORE_CACHE.get(key)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+        load_lock = _STORE_LOAD_LOCKS.setdefault(key, threading.Lock())
+    with load_lock:
+        # 等待載入鎖的期間，可能已經有別的 thread（例如 preload）載好了
+        with _STORE_CACHE_LOCK:
+            cached = _STORE_CACHE.get(key)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+        store = load_vector_store(path)
+        version = getattr(store, "snapshot_version", None)
+        if version is not None:
+            sig = ("version", version)
+        with _STORE_CACHE_LOCK:
+            _STORE_CACHE[key] = (sig, store)
+    return store
+
+
+def preload_vector_store(path: Optional[str] = None, background: bool = True):
+    """
+    開機時預先載入向量庫到共用快取。
+    path 省略時讀環境變數 ASKMYDOCS_PRELOAD_PATH，兩者都沒有就什麼都不做。
+    background=True 時在背景 thread 執行，不會擋住畫面第一次繪製；
+    同一個 path 在同一個 process 只會啟動一次。
+    """
+    path = path or os.environ.get(PRELOAD_ENV)
+    if not path:
+        return None
+
+    def _run():
+        start = time.perf_counter()
+        warm_imports()
+        if os.path.exists(path):
+            get_cached_vector_store(path)
+        TIMINGS.setdefault("preload", time.perf_counter() - start)
+
+    if not background:
+        _run()
+        return None
+    with _STORE_CACHE_LOCK:
+        thread = _PRELOAD_THREADS.get(path)
+        if thread is None:
+            thread = threading.Thread(target=_run, name="askmydocs-preload", daemon=True)
+            _PRELOAD_THREADS[path] = thread
+            thread.start()
+    return thread
+
+
+# ========= 分片向量庫（Sharded Store） =========
+
+SHARD_MANIFEST = "shards.json"
+SHARD_AUTHKEY_ENV = "ASKMYDOCS_SHARD_AUTHKEY"
+# 每個分片開幾條連線；一條連線同時間只能跑一個請求，多條才能讓同一分片並行查詢
+SHARD_CONNECTIONS = 4
+
+
+def _shard_authkey(authkey: Optional[bytes]) -> bytes:
+    """
+    遠端分片走的是 pickle RPC，authkey 等同於「能在分片主機上執行程式碼」的權限，
+    所以不提供預設值：沒有明確傳入時改讀環境變數，兩者都沒有就拒絕啟動。
+    """
+    if authkey is None:
+        value = os.environ.get(SHARD_AUTHKEY_ENV)
+        authkey = value.encode("utf-8") if value else None
+    if not authkey:
+        raise RuntimeError(
+            f"遠端分片需要 authkey：請傳入 authkey 參數或設定環境變數 {SHARD_AUTHKEY_ENV}。"
+        )
+    return authkey
+
+
+def shard_index_for(doc: Document, num_shards: int, by: str = "source") -> int:
+    """
+    決定一個 chunk 要放到哪個分片。
+    by='source'：同一個檔案的 chunk 都在同一分片，可單獨重建該檔案所在分片。
+    by='hash'：依 chunk 內容雜湊平均打散，分片大小較平均。
+    使用 md5 而不是 hash()，確保不同 process / 重啟後結果一致。
+    """
+    if by == "source":
+        key = str(doc.metadata.get("source", "unknown"))
+    elif by == "hash":
+        key = doc.page_content
+    else:
+        raise ValueError(f"不支援的分片方式：{by}（請用 'source' 或 'hash'）")
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def partition_docs(
+    docs: List[Document], num_shards: int, by: str = "source"
+) -> List[List[Document]]:
+    """
+    依 shard_index_for 把文件切成 num_shards 份。
+    """
+    parts: List[List[Document]] = [[] for _ in range(num_shards)]
+    for d in docs:
+        parts[shard_index_for(d, num_shards, by)].append(d)
+    return parts
+
+
+class _ShardServer:
+    """
+    單一分片的實際執行者：持有一個 FAISS（可能為空），處理 search / docs / build / load / save。
+    ProcessShard 的子行程與 serve_shard 的 RPC server 都是包一層這個類別。
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.store: Optional[FAISS] = None
+        self._lock = threading.Lock()
+        if path and has_snapshot(path):
+            self.store = load_vector_store(path)
+
+    def handle(self, op: str, *args):
+        if op == "search":
+            vector, k = args
+            store = self.store
+            if store is None:
+                return []
+            return store.similarity_search_with_score_by_vector(vector, k=k)
+        if op == "docs":
+            store = self.store
+            return dict(store.docstore._dict) if store is not None else {}
+        if op == "stats":
+            store = self.store
+            if store is None:
+                return {"num_docs": 0, "total_chars": 0, "avg_chars": 0, "per_source": {}}
+            return get_docs_stats_from_vector_store(store)
+        if op == "source_texts":
+            (source,) = args
+            store = self.store
+            return get_source_texts(store, source) if store is not None else []
+        if op == "build":
+            # 只換掉記憶體中的索引，不寫磁碟：self.path 可能是某個已發佈版本裡的
+            # shard_<i>，直接覆寫會破壞不可變的快照。要持久化請由上層重新發佈整個快照
+            # （ShardedVectorStore.rebuild_shard(..., path=...) / save_vector_store）。
+            (docs,) = args
+            store = build_vector_store(docs) if docs else None
+            with self._lock:
+                self.store = store
+            return len(docs)
+        if op == "load":
+            (path,) = args
+            store = None
+            if has_snapshot(path):
+                store = load_vector_store(path)
+            with self._lock:
+                self.path = path
+                self.store = store
+            return None
+        if op == "save":
+            (path,) = args
+            os.makedirs(path, exist_ok=True)
+            if self.store is not None:
+                self.store.save_local(path)
+            return None
+        if op == "ping":
+            return "pong"
+        raise ValueError(f"未知的分片指令：{op}")
+
+
+def _serve_connection(server: _ShardServer, conn):
+    """
+    在一條連線上反覆讀取 (op, *args)，回傳 ("ok", 結果) 或 ("error", 訊息)。
+    """
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        op, args = msg[0], msg[1:]
+        if op == "close":
+            conn.send(("ok", None))
+            break
+        try:
+            conn.send(("ok", server.handle(op, *args)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+def _shard_process_main(conns, path: Optional[str]):
+    """
+    ProcessShard 子行程進入點（需為 module-level 函式，spawn 才能 import）。
+    每條連線一個 thread，共用同一份分片資料；第一條連線關閉時子行程結束。
+    """
+    try:
+        server = _ShardServer(path)
+    except Exception as e:
+        conns[0].send(("error", f"{type(e).__name__}: {e}"))
+        for conn in conns:
+            conn.close()
+        return
+    for conn in conns[1:]:
+        threading.Thread(
+            target=_serve_connection, args=(server, conn), daemon=True
+        ).start()
+    conns[0].send(("ok", "ready"))
+    _serve_connection(server, conns[0])
+
+
+def serve_shard(
+    path: Optional[str],
+    address: Tuple[str, int] = ("127.0.0.1", 7001),
+    authkey: Optional[bytes] = None,
+):
+    """
+    以簡易 RPC（multiprocessing.connection）在另一台機器 / 行程上提供一個分片。
+    會一直阻塞；每條 client 連線由一個 thread 服務，共用同一份分片資料。
+    authkey 省略時讀環境變數 ASKMYDOCS_SHARD_AUTHKEY，沒有設定就拒絕啟動。
+    """
+    from multiprocessing import AuthenticationError
+    from multiprocessing.connection import Listener
+
+    authkey = _shard_authkey(authkey)
+    server = _ShardServer(path)
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError):
+                # authkey 錯誤或握手中斷的連線直接丟掉，不影響其他 client
+                continue
+            threading.Thread(
+                target=_serve_connection, args=(server, conn), daemon=True
+            ).start()
+
+
+class LocalShard:
+    """
+    同一個 process 內的分片（不開子行程，適合小型資料或測試）。
+    """
+
+    def __init__(self, store: Optional[FAISS] = None, path: Optional[str] = None):
+        self._server = _ShardServer(path)
+        if store is not None:
+            self._server.store = store
+
+    def search(self, vector: List[float], k: int) -> List[Tuple[Document, float]]:
+        return self._server.handle("search", vector, k)
+
+    def docs(self) -> Dict[str, Document]:
+        store = self._server.store
+        return store.docstore._dict if store is not None else {}
+
+    def stats(self) -> Dict:
+        return self._server.handle("stats")
+
+    def source_texts(self, source: str) -> List[str]:
+        return self._server.handle("source_texts", source)
+
+    def rebuild(self, docs: List[Document]) -> int:
+        return self._server.handle("build", docs)
+
+    def reload(self, path: str):
+        self._server.handle("load", path)
+
+    def save(self, path: str):
+        self._server.handle("save", path)
+
+    def close(self):
+        pass
+
+
+class _ShardClient:
+    """
+    透過 connection 呼叫遠端 _ShardServer。
+    一條連線同時間只能有一個請求，所以持有一組連線當作連線池：
+    每次呼叫借一條空閒的連線，用完歸還，同一分片可以同時處理多個查詢。
+    """
+
+    def __init__(self, conns):
+        self._conns = list(conns)
+        self._idle: "queue.Queue" = queue.Queue()
+        for conn in self._conns:
+            self._idle.put(conn)
+
+    def _call(self, op: str, *args):
+        conn = self._idle.get()
+        try:
+            conn.send((op,) + args)
+            status, result = conn.recv()
+        finally:
+            self._idle.put(conn)
+        if status != "ok":
+            raise RuntimeError(f"分片執行 {op} 失敗：{result}")
+        return result
+
+    def search(self, vector: List[float], k: int) -> List[Tuple[Document, float]]:
+        return self._call("search", vector, k)
+
+    def docs(self) -> Dict[str, Document]:
+        return self._call("docs")
+
+    def stats(self) -> Dict:
+        return self._call("stats")
+
+    def source_texts(self, source: str) -> List[str]:
+        return self._call("source_texts", source)
+
+    def rebuild(self, docs: List[Document]) -> int:
+        return self._call("build", docs)
+
+    def reload(self, path: str):
+        self._call("load", path)
+
+    def save(self, path: str):
+        self._call("save", path)
+
+    def close(self):
+        # 反向關閉：ProcessShard 的子行程在第一條連線關閉時才結束
+        for conn in reversed(self._conns):
+            try:
+                conn.send(("close",))
+                conn.recv()
+            except (EOFError, OSError):
+                pass
+            conn.close()
+
+
+class ProcessShard(_ShardClient):
+    """
+    由獨立子行程服務的分片：每個分片各自一顆 CPU、各自一份記憶體。
+    path 可省略，此時分片只存在子行程記憶體中，之後用 rebuild() 填資料。
+    wait=False 時只啟動子行程、不等它載入完成，之後再呼叫 wait_ready()；
+    這樣多個分片可以同時啟動、同時載入索引。
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        connections: int = SHARD_CONNECTIONS,
+        wait: bool = True,
+    ):
+        import multiprocessing as mp
+
+        ctx = mp.get_context("spawn")
+        pairs = [ctx.Pipe() for _ in range(max(1, connections))]
+        child_conns = [child for _, child in pairs]
+        self.process = ctx.Process(
+            target=_shard_process_main, args=(child_conns, path), daemon=True
+        )
+        self.process.start()
+        for conn in child_conns:
+            conn.close()
+        super().__init__([parent for parent, _ in pairs])
+        self._ready = False
+        if wait:
+            self.wait_ready()
+
+    def wait_ready(self):
+        if self._ready:
+            return
+        try:
+            status, result = self._conns[0].recv()
+        except EOFError:
+            status, result = "error", "子行程提前結束"
+        if status != "ok":
+            self.process.join(timeout=5)
+            raise RuntimeError(f"分片子行程啟動失敗：{result}")
+        self._ready = True
+
+    def close(self):
+        super().close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+def _start_process_shards(paths: List[Optional[str]]) -> List[ProcessShard]:
+    """
+    先把所有子行程都啟動，再逐一等待就緒：總啟動時間約等於最慢的那個分片，
+    而不是所有分片載入時間的總和。
+    """
+    shards = [ProcessShard(p, wait=False) for p in paths]
+    try:
+        for shard in shards:
+            shard.wait_ready()
+    except Exception:
+        for shard in shards:
+            shard.process.terminate()
+        raise
+    return shards
+
+
+class RemoteShard(_ShardClient):
+    """
+    連到 serve_shard() 開出來的遠端分片（serve_shard 每條連線一個 thread，
+    所以開多條連線即可並行查詢）。
+    authkey 省略時讀環境變數 ASKMYDOCS_SHARD_AUTHKEY，沒有設定就拒絕連線。
+    """
+
+    def __init__(
+        self,
+        address: Tuple[str, int],
+        authkey: Optional[bytes] = None,
+        connections: int = SHARD_CONNECTIONS,
+    ):
+        from multiprocessing.connection import Client
+
+        authkey = _shard_authkey(authkey)
+        self.address = address
+        super().__init__(
+            [Client(address, authkey=authkey) for _ in range(max(1, connections))]
+        )
+
+
+class _ShardedDocstore:
+    """
+    讓 get_all_docs_from_vector_store 等函式照舊讀 vector_store.docstore._dict。
+    """
+
+    def __init__(self, owner: "ShardedVectorStore"):
+        # 用 weakref：store ↔ docstore 不形成循環參照，最後一個參照消失時
+        # store 立刻被回收、分片子行程跟著關閉，不用等 cyclic GC
+        self._owner_ref = weakref.ref(owner)
+
+    @property
+    def _owner(self) -> "ShardedVectorStore":
+        owner = self._owner_ref()
+        if owner is None:
+            raise RuntimeError("分片向量庫已經關閉。")
+        return owner
+
+    @property
+    def _dict(self) -> ChainMap:
+        return ChainMap(*self._owner._shard_docs())
+
+    def search(self, doc_id: str):
+        return self._dict.get(doc_id, f"ID {doc_id} not found.")
+
+    def stats(self) -> Dict:
+        """
+        各分片各自算統計（不傳 Document 回來），這裡只做加總。
+        """
+        shards = self._owner.shards
+        total_docs = 0
+        total_chars = 0
+        per_source: Dict[str, int] = {}
+        for st in self._owner._pool.map(lambda s: s.stats(), shards):
+            total_docs += st["num_docs"]
+            total_chars += st["total_chars"]
+            for src, cnt in st["per_source"].items():
+                per_source[src] = per_source.get(src, 0) + cnt
+        return {
+            "num_docs": total_docs,
+            "total_chars": total_chars,
+            "avg_chars": total_docs and total_chars / total_docs or 0,
+            "per_source": per_source,
+        }
+
+    def texts_for_source(self, source: str) -> List[str]:
+        shards = self._owner.shards
+        results = self._owner._pool.map(lambda s: s.source_texts(source), shards)
+        return [t for texts in results for t in texts]
+
+
+def _close_shards(shards: List, pool: ThreadPoolExecutor):
+    for shard in shards:
+        shard.close()
+    pool.shutdown(wait=False)
+
+
+class ShardedVectorStore:
+    """
+    分片向量庫：scatter-gather 查詢。
+    - 查詢時只在本地做一次 query embedding，再把向量平行送到所有分片，
+      各分片回傳自己的 top-k，最後合併取全域 top-k。
+    - 提供與 FAISS 相同的 similarity_search_with_score / docstore._dict，
+      semantic_search、SimpleRetrievalQA、統計函式都不用改。
+    - 分數沿用 FAISS 預設的 L2 距離（越小越相似），合併時取最小的 k 個。
+    - max_workers 是 scatter 用的 thread 數，預設「分片數 × 每分片連線數」，
+      讓多個使用者同時查詢時不會在這裡排隊。
+    """
+
+    def __init__(
+        self,
+        shards: List,
+        by: str = "source",
+        embeddings=None,
+        max_workers: Optional[int] = None,
+    ):
+        if not shards:
+            raise ValueError("ShardedVectorStore 至少需要一個分片。")
+        self.shards = list(shards)
+        self.by = by
+        self.embeddings = embeddings or get_embeddings()
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers or len(self.shards) * SHARD_CONNECTIONS
+        )
+        self._docs_cache: Dict[int, Dict[str, Document]] = {}
+        self.docstore = _ShardedDocstore(self)
+        # 沒有人呼叫 close() 時（例如共用快取換成新版本、舊版本不再被任何 session 使用），
+        # 在物件被回收時關閉分片；close() 與回收只會執行一次
+        self._finalizer = weakref.finalize(self, _close_shards, self.shards, self._pool)
+
+    @property
+    def num_shards(self) -> int:
+        return len(self.shards)
+
+    def _shard_docs(self) -> List[Dict[str, Document]]:
+        missing = [i for i in range(self.num_shards) if i not in self._docs_cache]
+        for i, docs in zip(
+            missing, self._pool.map(lambda i: self.shards[i].docs(), missing)
+        ):
+            self._docs_cache[i] = docs
+        return [self._docs_cache[i] for i in range(self.num_shards)]
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs
+    ) -> List[Tuple[Document, float]]:
+        per_shard = self._pool.map(lambda s: s.search(embedding, k), self.shards)
+        merged = [item for results in per_shard for item in results]
+        return heapq.nsmallest(k, merged, key=lambda pair: pair[1])
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs
+    ) -> List[Tuple[Document, float]]:
+        embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(embedding, k=k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def shard_for(self, doc: Document) -> int:
+        return shard_index_for(doc, self.num_shards, self.by)
+
+    def rebuild_shard(
+        self,
+        index: int,
+        docs: List[Document],
+        path: Optional[str] = None,
+        doc_summaries: Optional[Dict[str, str]] = None,
+    ) -> int:
+        """
+        只重建第 index 個分片（其他分片照常服務查詢）。
+        docs 應為該分片「全部」的文件，例如某個檔案更新後重新切好的 chunk。
+        重建只發生在記憶體中；給 path 時會用 save_vector_store 把整個分片庫
+        發佈成 path 底下的新版本（新 version 資料夾 + 原子切換 CURRENT）。
+        """
+        wrong = [d for d in docs if self.shard_for(d) != index]
+        if wrong:
+            raise ValueError(
+                f"有 {len(wrong)} 個文件不屬於分片 {index}，請先用 partition_docs 分好。"
+            )
+        n = self.shards[index].rebuild(docs)
+        self._docs_cache.pop(index, None)
+        if path:
+            self.snapshot_version = save_vector_store(
+                self, path, doc_summaries=doc_summaries
+            )
+        return n
+
+    def save_local(self, folder_path: str):
+        """
+        每個分片存到 folder_path/shard_<i>，並寫入 shards.json 描述分片方式。
+        """
+        os.makedirs(folder_path, exist_ok=True)
+        for i, shard in enumerate(self.shards):
+            shard.save(os.path.join(folder_path, f"shard_{i}"))
+        with open(os.path.join(folder_path, SHARD_MANIFEST), "w", encoding="utf-8") as f:
+            json.dump({"num_shards": self.num_shards, "by": self.by}, f)
+
+    def close(self):
+        self._finalizer()
+
+
+def build_sharded_vector_store(
+    docs: List[Document],
+    num_shards: int = 4,
+    by: str = "source",
+    mode: str = "process",
+) -> ShardedVectorStore:
+    """
+    建立分片向量庫。
+    mode='process'：每個分片一個子行程，embedding 與建索引也在子行程內平行進行。
+    mode='local'：全部分片在同一個 process 內（仍然平行查詢）。
+    """
+    if mode == "process":
+        shards = _start_process_shards([None] * num_shards)
+    elif mode == "local":
+        shards = [LocalShard() for _ in range(num_shards)]
+    else:
+        raise ValueError(f"不支援的分片模式：{mode}（請用 'process' 或 'local'）")
+    store = ShardedVectorStore(shards, by=by)
+    parts = partition_docs(docs, num_shards, by)
+    list(store._pool.map(lambda i: shards[i].rebuild(parts[i]), range(num_shards)))
+    return store
+
+
+def load_sharded_vector_store(path: str, mode: str = "process") -> ShardedVectorStore:
+    """
+    從 save_local 存下的資料夾載入分片向量庫。
+    """
+    with open(os.path.join(path, SHARD_MANIFEST), encoding="utf-8") as f:
+        manifest = json.load(f)
+    paths = [os.path.join(path, f"shard_{i}") for i in range(manifest["num_shards"])]
+    if mode == "process":
+        shards = _start_process_shards(paths)
+    elif mode == "local":
+        shards = [LocalShard(path=p) for p in paths]
+    else:
+        raise ValueError(f"不支援的分片模式：{mode}（請用 'process' 或 'local'）")
+    return ShardedVectorStore(shards, by=manifest.get("by", "source"))
+
+
+# ========= LLM 結果快取（摘要 / 文件比較） =========
+
+# prompt 內容有改時請調整版本號，舊的快取結果就不會再被使用
+SUMMARY_PROMPT_VERSION = "summary-v1"
+COMPARE_PROMPT_VERSION = "compare-v1"
+
+RESULT_CACHE_ENV = "ASKMYDOCS_CACHE_PATH"
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+_RESULT_CACHES: Dict[str, "ResultCache"] = {}
+_RESULT_CACHES_LOCK = threading.Lock()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def make_cache_key(*parts) -> str:
+    """
+    把 (操作, prompt 版本, 內容雜湊, language_mode, model, ...) 組成一個固定長度的 key。
+    """
+    raw = json.dumps([str(p) for p in parts], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    以 SQLite 存在本機的 LLM 結果快取，重啟 / 換 session 後仍有效。
+    - 總大小超過 max_bytes 時，依最後使用時間淘汰最舊的結果（LRU）。
+    - 每次操作各自開連線，可以被多個 Streamlit session thread 同時使用。
+    """
+
+    def __init__(self, path: str = "llm_cache.sqlite", max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS results_last_used ON results(last_used)"
+            )
+
+    def _connect(self):
+        import sqlite3
+
+        return sqlite3.connect(self.path, timeout=30)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        `with sqlite3.connect() as conn` 只會 commit / rollback，不會關閉連線，
+        所以外層再用 closing() 確保每次操作結束就把連線關掉。
+        """
+        with closing(self._connect()) as conn:
+            with conn:
+                yield conn
+
+    def _count(self, name: str):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._count("misses")
+                return None
+            conn.execute(
+                "UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+        self._count("hits")
+        return row[0]
+
+    def put(self, key: str, value: str):
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, last_used)"
+                " VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute("SELECT key, size FROM results ORDER BY last_used").fetchall()
+        doomed = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM results WHERE key = ?", doomed)
+
+    def stats(self) -> Dict:
+        with self._transaction() as conn:
+            count, total = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+        with self._counter_lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "entries": count,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+        }
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM results")
+
+
+def get_result_cache(path: Optional[str] = None) -> ResultCache:
+    """
+    取得（同一個 process 共用的）ResultCache；path 省略時讀 ASKMYDOCS_CACHE_PATH，
+    預設為 llm_cache.sqlite。
+    """
+    path = path or os.environ.get(RESULT_CACHE_ENV, "llm_cache.sqlite")
+    key = os.path.abspath(path)
+    with _RESULT_CACHES_LOCK:
+        cache = _RESULT_CACHES.get(key)
+        if cache is None:
+            cache = ResultCache(path)
+            _RESULT_CACHES[key] = cache
+    return cache
+
+
+# ========= Session 記憶體管理（閒置 session spill 到磁碟） =========
+
+SESSION_SPILL_DIR_ENV = "ASKMYDOCS_SPILL_DIR"
+SESSION_BUDGET_ENV = "ASKMYDOCS_SESSION_BUDGET_MB"
+GLOBAL_BUDGET_ENV = "ASKMYDOCS_GLOBAL_BUDGET_MB"
+SESSION_IDLE_ENV = "ASKMYDOCS_SESSION_IDLE_SECONDS"
+SESSION_MESSAGES_FILE = "messages.json"
+
+_SESSION_MANAGER: Optional["SessionStoreManager"] = None
+_SESSION_MANAGER_LOCK = threading.Lock()
+
+
+class SessionBudgetExceeded(RuntimeError):
+    """
+    單一 session 的向量庫超過每個 session 的記憶體上限。
+    """
+
+
+def estimate_vector_store_bytes(vector_store) -> int:
+    """
+    粗估向量庫在本 process 佔用的記憶體：向量本身 + docstore + id 對照表。
+    分片向量庫只算同 process 內的 LocalShard（子行程 / 遠端分片不佔本 process 記憶體）。
+    """
+    if vector_store is None:
+        return 0
+    if isinstance(vector_store, ShardedVectorStore):
+        return sum(
+            estimate_vector_store_bytes(shard._server.store)
+            for shard in vector_store.shards
+            if isinstance(shard, LocalShard)
+        )
+    total = 0
+    index = getattr(vector_store, "index", None)
+    if index is not None:
+        total += int(index.ntotal) * int(index.d) * 4
+    docstore = getattr(vector_store, "docstore", None)
+    if hasattr(docstore, "memory_bytes"):
+        total += docstore.memory_bytes()
+    elif hasattr(docstore, "_dict"):
+        # InMemoryDocstore：str 約 2 bytes/字，再加上 Document 與 metadata dict 的固定成本
+        total += sum(2 * len(d.page_content) + 600 for d in docstore._dict.values())
+    total += len(getattr(vector_store, "index_to_docstore_id", {})) * 120
+    return total
+
+
+def _text_payload_bytes(obj) -> int:
+    """
+    messages / doc_summaries 這類純文字資料的粗估大小。
+    """
+    if isinstance(obj, str):
+        return 2 * len(obj) + 50
+    if isinstance(obj, dict):
+        return sum(_text_payload_bytes(k) + _text_payload_bytes(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return sum(_text_payload_bytes(v) for v in obj)
+    return 32
+
+
+class SessionEntry:
+    """
+    一個 Streamlit session 的大型狀態。app 透過 manager 取得它，而不是直接放在 st.session_state，
+    這樣 manager 才能在 session 閒置時把它 spill 到磁碟、釋放記憶體。
+    欄位的寫入請透過 manager（update / append_message），manager 才知道 session 被動過。
+    """
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.vector_store = None
+        self.qa_chain = None
+        self.docs_stats: Optional[Dict] = None
+        self.messages: List[Dict] = []
+        self.doc_summaries: Dict[str, str] = {}
+        # 來自共用快取（get_cached_vector_store）的向量庫不算在這個 session 的記憶體裡，
+        # spill 時也只要記住路徑，之後重新從共用快取取得即可
+        self.shared_path: Optional[str] = None
+        self.store_bytes = 0
+        self.last_access = time.time()
+        # 每次被存取就 +1；背景 spill 寫完磁碟後若發現 generation 變了，就放棄這次 spill
+        self.generation = 0
+        # script 執行中（acquire 之後、release 之前）不會被 spill / 移除；用租期避免 release 沒跑到
+        self.busy_until = 0.0
+        self.spilled = False
+        self.spilling = False
+        # spill / reload 的磁碟 I/O 用這個鎖，不佔用 manager 的全域鎖
+        self.io_lock = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return time.time() < self.busy_until
+
+    @property
+    def is_empty(self) -> bool:
+        return (
+            not self.spilled
+            and self.vector_store is None
+            and not self.messages
+            and not self.doc_summaries
+            and self.docs_stats is None
+        )
+
+    @property
+    def resident_bytes(self) -> int:
+        if self.spilled:
+            return 0
+        return (
+            self.store_bytes
+            + _text_payload_bytes(self.messages)
+            + _text_payload_bytes(self.doc_summaries)
+        )
+
+
+class SessionStoreManager:
+    """
+    追蹤每個 session 與全部 session 的記憶體用量：
+    - 單一 session 的向量庫超過 session_budget_bytes → update() 丟出 SessionBudgetExceeded
+    - 閒置超過 idle_seconds 的 session → spill 到 spill_dir（版本化快照格式），釋放記憶體；
+      沒有任何狀態的空 session 直接移除
+    - 總量超過 global_budget_bytes → 依最久沒用（LRU）順序 spill，至少閒置 min_idle_seconds 才動
+    - spill 後的 session 下次 get() 時自動從磁碟載回
+    - 閒置超過 expire_seconds 的 session 不論是否已 spill 都整個刪除
+      （瀏覽器關掉後 Streamlit 不會通知）
+    - acquire() 之後到 release()（或租期 busy_lease_seconds 到期）之間，session 不會被 spill
+    spill 的磁碟 I/O 在背景 thread 進行，不會佔住全域鎖、也不會拖慢其他使用者的 get()。
+    budget 為 0 表示不限制。
+    """
+
+    def __init__(
+        self,
+        spill_dir: str = "session_spill",
+        session_budget_bytes: int = 0,
+        global_budget_bytes: int = 0,
+        idle_seconds: float = 600,
+        min_idle_seconds: float = 60,
+        expire_seconds: float = 86400,
+        busy_lease_seconds: float = 300,
+    ):
+        self.spill_dir = spill_dir
+        self.session_budget_bytes = session_budget_bytes
+        self.global_budget_bytes = global_budget_bytes
+        self.idle_seconds = idle_seconds
+        self.min_idle_seconds = min_idle_seconds
+        self.expire_seconds = expire_seconds
+        self.busy_lease_seconds = busy_lease_seconds
+        self._entries: Dict[str, SessionEntry] = {}
+        self._lock = threading.RLock()
+        # 只用一個 worker：同一個 session 的 spill / 刪除依提交順序執行，不會互相覆蓋
+        self._io_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="askmydocs-spill")
+        self._metrics = {
+            "spills": 0,
+            "spill_aborts": 0,
+            "spill_errors": 0,
+            "reloads": 0,
+            "expired": 0,
+            "spilled_bytes": 0,
+            "budget_rejections": 0,
+            "over_budget_events": 0,
+        }
+
+    @classmethod
+    def from_env(cls) -> "SessionStoreManager":
+        mb = 1024 * 1024
+        return cls(
+            spill_dir=os.environ.get(SESSION_SPILL_DIR_ENV, "session_spill"),
+            session_budget_bytes=int(float(os.environ.get(SESSION_BUDGET_ENV, "0")) * mb),
+            global_budget_bytes=int(float(os.environ.get(GLOBAL_BUDGET_ENV, "0")) * mb),
+            idle_seconds=float(os.environ.get(SESSION_IDLE_ENV, "600")),
+        )
+
+    def _spill_path(self, session_id: str) -> str:
+        safe = hashlib.md5(session_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.spill_dir, safe)
+
+    def _touch(self, entry: SessionEntry):
+        entry.last_access = time.time()
+        entry.generation += 1
+
+    def _checkout(self, session_id: str, lease: float = 0) -> SessionEntry:
+        """
+        取得（必要時建立）entry 並標記為剛被使用；已 spill 的話在全域鎖外載回。
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                entry = SessionEntry(session_id)
+                self._entries[session_id] = entry
+            self._touch(entry)
+            if lease:
+                entry.busy_until = max(entry.busy_until, time.time() + lease)
+            spilled = entry.spilled
+        if spilled:
+            with entry.io_lock:
+                if entry.spilled:
+                    self._reload(entry)
+        return entry
+
+    def get(self, session_id: str) -> SessionEntry:
+        """
+        取得 session 狀態（必要時從磁碟載回），並順便執行一次閒置 / 總量檢查。
+        """
+        entry = self._checkout(session_id)
+        self.enforce(exclude=session_id)
+        return entry
+
+    def acquire(self, session_id: str) -> SessionEntry:
+        """
+        與 get() 相同，但同時把 session 標記為執行中：在 release() 或租期到期之前不會被 spill。
+        app.py 在 script 開頭呼叫，結尾呼叫 release()。
+        """
+        entry = self._checkout(session_id, lease=self.busy_lease_seconds)
+        self.enforce(exclude=session_id)
+        return entry
+
+    def release(self, session_id: str):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry.busy_until = 0.0
+                self._touch(entry)
+
+    def update(self, session_id: str, **fields) -> SessionEntry:
+        """
+        更新 session 的欄位（vector_store / qa_chain / docs_stats / messages / doc_summaries / shared_path）。
+        換了 vector_store 會重新估算大小並檢查 budget。
+        """
+        entry = self._checkout(session_id)
+        with self._lock:
+            if "vector_store" in fields:
+                vector_store = fields["vector_store"]
+                shared_path = fields.get("shared_path")
+                store_bytes = 0 if shared_path else estimate_vector_store_bytes(vector_store)
+                if self.session_budget_bytes and store_bytes > self.session_budget_bytes:
+                    self._metrics["budget_rejections"] += 1
+                    raise SessionBudgetExceeded(
+                        f"向量庫約 {store_bytes / 2**20:.1f} MB，超過每個 session 上限 "
+                        f"{self.session_budget_bytes / 2**20:.1f} MB，請減少上傳的文件。"
+                    )
+                entry.store_bytes = store_bytes
+                entry.shared_path = shared_path
+            for name, value in fields.items():
+                if name != "shared_path":
+                    setattr(entry, name, value)
+            self._touch(entry)
+        self.enforce(exclude=session_id)
+        return entry
+
+    def append_message(self, session_id: str, message: Dict) -> SessionEntry:
+        """
+        在對話紀錄後面加一則訊息（app 不要直接 sess.messages.append，否則 spill 時可能遺失）。
+        """
+        entry = self._checkout(session_id)
+        with self._lock:
+            entry.messages.append(message)
+            self._touch(entry)
+        return entry
+
+    def enforce(self, exclude: Optional[str] = None, wait: bool = False):
+        """
+        移除過期 / 閒置的空 session、spill 閒置過久的 session；
+        總量超過上限時再依 LRU spill，直到回到上限以下。
+        這裡只決定要處理哪些 session，磁碟 I/O 交給背景 thread；wait=True 時等它們做完。
+        """
+        now = time.time()
+        to_spill: List[SessionEntry] = []
+        to_remove: List[str] = []
+        with self._lock:
+            for sid, entry in list(self._entries.items()):
+                if sid == exclude or entry.busy or entry.spilling:
+                    continue
+                idle = now - entry.last_access
+                if idle > self.expire_seconds or (entry.is_empty and idle > self.idle_seconds):
+                    self._entries.pop(sid)
+                    to_remove.append(sid)
+                    self._metrics["expired"] += 1
+                elif not entry.spilled and idle > self.idle_seconds:
+                    entry.spilling = True
+                    to_spill.append(entry)
+
+            if self.global_budget_bytes:
+                total = sum(
+                    e.resident_bytes for e in self._entries.values() if not e.spilling
+                )
+                if total > self.global_budget_bytes:
+                    candidates = sorted(
+                        (
+                            e
+                            for e in self._entries.values()
+                            if not e.spilled
+                            and not e.spilling
+                            and not e.busy
+                            and e.session_id != exclude
+                            and e.resident_bytes
+                            and now - e.last_access >= self.min_idle_seconds
+                        ),
+                        key=lambda e: e.last_access,
+                    )
+                    for entry in candidates:
+                        if total <= self.global_budget_bytes:
+                            break
+                        total -= entry.resident_bytes
+                        entry.spilling = True
+                        to_spill.append(entry)
+                    if total > self.global_budget_bytes:
+                        self._metrics["over_budget_events"] += 1
+
+        futures = [self._io_pool.submit(self._remove_files, sid) for sid in to_remove]
+        futures += [self._io_pool.submit(self._spill, entry) for entry in to_spill]
+        if wait:
+            for future in futures:
+                future.result()
+
+    def _spill(self, entry: SessionEntry):
+        """
+        背景 thread 執行：先在鎖內拍下狀態，鎖外寫磁碟，最後確認期間沒人用過才釋放記憶體。
+        """
+        try:
+            with entry.io_lock:
+                with self._lock:
+                    if entry.spilled or self._entries.get(entry.session_id) is not entry:
+                        return
+                    generation = entry.generation
+                    vector_store = entry.vector_store
+                    state = {
+                        "messages": list(entry.messages),
+                        "doc_summaries": dict(entry.doc_summaries),
+                        "docs_stats": entry.docs_stats,
+                        "shared_path": entry.shared_path,
+                        "has_store": vector_store is not None,
+                    }
+                    freed = entry.resident_bytes
+
+                path = self._spill_path(entry.session_id)
+                os.makedirs(path, exist_ok=True)
+                if vector_store is not None and not state["shared_path"]:
+                    save_vector_store(vector_store, path, keep=1)
+                tmp = os.path.join(path, f".{SESSION_MESSAGES_FILE}.tmp")
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(state, f, ensure_ascii=False)
+                os.replace(tmp, os.path.join(path, SESSION_MESSAGES_FILE))
+
+                with self._lock:
+                    if (
+                        entry.generation != generation
+                        or entry.busy
+                        or self._entries.get(entry.session_id) is not entry
+                    ):
+                        # 寫磁碟期間 session 又被用了：保留記憶體中的版本，磁碟上的下次再覆蓋
+                        self._metrics["spill_aborts"] += 1
+                        return
+                    entry.vector_store = None
+                    entry.qa_chain = None
+                    entry.messages = []
+                    entry.doc_summaries = {}
+                    entry.docs_stats = None
+                    entry.spilled = True
+                    self._metrics["spills"] += 1
+                    self._metrics["spilled_bytes"] += freed
+        except Exception:
+            with self._lock:
+                self._metrics["spill_errors"] += 1
+        finally:
+            entry.spilling = False
+
+    def _reload(self, entry: SessionEntry):
+        """
+        呼叫端持有 entry.io_lock；讀磁碟時不持有全域鎖。
+        """
+        path = self._spill_path(entry.session_id)
+        with open(os.path.join(path, SESSION_MESSAGES_FILE), encoding="utf-8") as f:
+            state = json.load(f)
+        shared_path = state.get("shared_path")
+        vector_store = None
+        if state.get("has_store"):
+            if shared_path:
+                vector_store = get_cached_vector_store(shared_path)
+            else:
+                vector_store = load_vector_store(path)
+        store_bytes = 0 if shared_path else estimate_vector_store_bytes(vector_store)
+        with self._lock:
+            entry.messages = state.get("messages", [])
+            entry.doc_summaries = state.get("doc_summaries", {})
+            entry.docs_stats = state.get("docs_stats")
+            entry.shared_path = shared_path
+            entry.vector_store = vector_store
+            entry.store_bytes = store_bytes
+            entry.spilled = False
+            self._touch(entry)
+            self._metrics["reloads"] += 1
+
+    def _remove_files(self, session_id: str):
+        import shutil
+
+        shutil.rmtree(self._spill_path(session_id), ignore_errors=True)
+
+    def drop(self, session_id: str):
+        """
+        直接移除 session（記憶體與磁碟上的 spill 都清掉）。
+        """
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._io_pool.submit(self._remove_files, session_id).result()
+
+    def metrics(self) -> Dict:
+        with self._lock:
+            entries = list(self._entries.values())
+            return {
+                "sessions": len(entries),
+                "resident_sessions": sum(1 for e in entries if not e.spilled),
+                "spilled_sessions": sum(1 for e in entries if e.spilled),
+                "busy_sessions": sum(1 for e in entries if e.busy),
+                "resident_bytes": sum(e.resident_bytes for e in entries),
+                "session_budget_bytes": self.session_budget_bytes,
+                "global_budget_bytes": self.global_budget_bytes,
+                **self._metrics,
+            }
+
+
+def get_session_manager() -> SessionStoreManager:
+    """
+    同一個 server process 共用的 SessionStoreManager（設定從環境變數讀取）。
+    """
+    global _SESSION_MANAGER
+    with _SESSION_MANAGER_LOCK:
+        if _SESSION_MANAGER is None:
+            _SESSION_MANAGER = SessionStoreManager.from_env()
+    return _SESSION_MANAGER
+
+
 # ========= 摘要、語意搜尋、文件比較 =========
 
 def summarize_text(
@@ -118,12 +2189,24 @@ def summarize_text(
     language_mode: str = "zh",
     model: str = "gpt-4o-mini",
     max_chars: int = 6000,
+    cache: Optional[ResultCache] = None,
 ) -> str:
     """
     對單一檔案內容做摘要。
     language_mode: 'zh' / 'en' / 'bi'
+    有傳 cache 時，相同內容 / 語言 / 模型 / prompt 版本會直接回傳之前的結果。
     """
     snippet = text[:max_chars]
+    cache_key = make_cache_key(
+        "summary", SUMMARY_PROMPT_VERSION, content_hash(snippet), language_mode, model
+    )
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    from langchain_openai import ChatOpenAI
+
     llm = ChatOpenAI(model=model, temperature=0.2)
 
     if language_mode == "en":
@@ -141,7 +2224,10 @@ def summarize_text(
 {snippet}
 """
     res = llm.invoke(prompt)
-    return res.content if hasattr(res, "content") else str(res)
+    result = res.content if hasattr(res, "content") else str(res)
+    if cache is not None:
+        cache.put(cache_key, result)
+    return result
 
 
 def semantic_search(
@@ -161,16 +2247,31 @@ def compare_two_sources(
     language_mode: str = "zh",
     model: str = "gpt-4o-mini",
     max_chars_each: int = 4000,
+    cache: Optional[ResultCache] = None,
 ) -> str:
     """
     比較兩份文件的異同。
+    有傳 cache 時，同一組文件內容重複比較會直接回傳之前的結果。
     """
-    groups = group_docs_by_source(vector_store)
-    docs_a = groups.get(source_a, [])
-    docs_b = groups.get(source_b, [])
+    text_a = "\n".join(get_source_texts(vector_store, source_a))[:max_chars_each]
+    text_b = "\n".join(get_source_texts(vector_store, source_b))[:max_chars_each]
+
+    cache_key = make_cache_key(
+        "compare",
+        COMPARE_PROMPT_VERSION,
+        source_a,
+        content_hash(text_a),
+        source_b,
+        content_hash(text_b),
+        language_mode,
+        model,
+    )
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-    text_a = "\n".join(d.page_content for d in docs_a)[:max_chars_each]
-    text_b = "\n".join(d.page_content for d in docs_b)[:max_chars_each]
+    from langchain_openai import ChatOpenAI
 
     llm = ChatOpenAI(model=model, temperature=0.2)
 
@@ -198,7 +2299,10 @@ def compare_two_sources(
 """
 
     res = llm.invoke(prompt)
-    return res.content if hasattr(res, "content") else str(res)
+    result = res.content if hasattr(res, "content") else str(res)
+    if cache is not None:
+        cache.put(cache_key, result)
+    return result
 
 
 # ========= 簡易 RAG 問答類別 =========
@@ -226,6 +2330,9 @@ class SimpleRetrievalQA:
         self.k = k
         self.temperature = temperature
         self.model = model
+
+        from langchain_openai import ChatOpenAI
+
         self.llm = ChatOpenAI(
             model=model,
             temperature=temperature,
@@ -0,0 +1,297 @@
+# stub_openai_server.py
+#
+# 本機的 OpenAI 相容 stub server，給壓力測試（loadtest.py）用，不會花到任何 API 費用。
+# 支援：
+#   POST /v1/embeddings        依文字雜湊產生固定的向量（同樣的字 → 同樣的向量，檢索結果有意義）
+#   POST /v1/chat/completions  回傳假的回答，支援 stream=true（SSE）
+#   GET  /v1/models
+# 可以設定延遲、抖動、串流每個 token 的間隔與錯誤率。
+#
+# 用法：
+#   python stub_openai_server.py --port 8765 --latency-ms 200 --error-rate 0.01
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub streamlit run app.py
+
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubConfig:
+    def __init__(
+        self,
+        latency_ms: float = 50.0,
+        jitter_ms: float = 20.0,
+        embedding_latency_ms: float = 20.0,
+        stream_delay_ms: float = 10.0,
+        error_rate: float = 0.0,
+        embedding_dim: int = 256,
+        answer_tokens: int = 40,
+    ):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.embedding_latency_ms = embedding_latency_ms
+        self.stream_delay_ms = stream_delay_ms
+        self.error_rate = error_rate
+        self.embedding_dim = embedding_dim
+        self.answer_tokens = answer_tokens
+
+
+def fake_embedding(text, dim: int):
+    """
+    hashing trick：每個詞（中文則每個字）丟到一個維度上，最後做 L2 正規化。
+    text 也可以是 token id 的 list（OpenAIEmbeddings 會先用 tiktoken 斷詞再送出）。
+    """
+    if isinstance(text, list):
+        tokens = [str(t) for t in text]
+    else:
+        tokens = []
+        for word in text.split():
+            if word.isascii():
+                tokens.append(word.lower())
+            else:
+                tokens.extend(word)
+    vec = [0.0] * dim
+    for tok in tokens:
+        h = int.from_bytes(hashlib.md5(tok.encode("utf-8")).digest()[:8], "big")
+        vec[h % dim] += 1.0 if (h >> 63) == 0 else -1.0
+    norm = math.sqrt(sum(x * x for x in vec)) or 1.0
+    return [x / norm for x in vec]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = "AskMyDocsStub/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def config(self) -> StubConfig:
+        return self.server.config
+
+    def log_message(self, format, *args):
+        pass
+
+    def _sleep(self, base_ms: float):
+        jitter = random.uniform(-self.config.jitter_ms, self.config.jitter_ms)
+        delay = max(0.0, base_ms + jitter) / 1000
+        if delay:
+            time.sleep(delay)
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _maybe_fail(self) -> bool:
+        if self.config.error_rate and random.random() < self.config.error_rate:
+            self.server.count("errors")
+            status = random.choice([429, 500, 503])
+            self._send_json(
+                status,
+                {"error": {"message": f"stub injected error {status}", "type": "server_error"}},
+            )
+            return True
+        return False
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(
+                200,
+                {
+                    "object": "list",
+                    "data": [
+                        {"id": "gpt-4o-mini", "object": "model", "owned_by": "stub"},
+                        {"id": "text-embedding-3-small", "object": "model", "owned_by": "stub"},
+                    ],
+                },
+            )
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+        path = self.path.rstrip("/")
+        if path.endswith("/embeddings"):
+            self._embeddings(body)
+        elif path.endswith("/chat/completions"):
+            self._chat(body)
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def _embeddings(self, body: dict):
+        self.server.count("embeddings")
+        self._sleep(self.config.embedding_latency_ms)
+        if self._maybe_fail():
+            return
+        inputs = body.get("input", [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dim = int(body.get("dimensions") or self.config.embedding_dim)
+        data = [
+            {"object": "embedding", "index": i, "embedding": fake_embedding(text, dim)}
+            for i, text in enumerate(inputs)
+        ]
+        n_tokens = sum(len(t) if isinstance(t, list) else len(t.split()) for t in inputs)
+        self._send_json(
+            200,
+            {
+                "object": "list",
+                "data": data,
+                "model": body.get("model", "text-embedding-3-small"),
+                "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+            },
+        )
+
+    def _answer_tokens(self, body: dict):
+        messages = body.get("messages") or []
+        prompt = messages[-1].get("content", "") if messages else ""
+        if isinstance(prompt, list):
+            prompt = " ".join(p.get("text", "") for p in prompt if isinstance(p, dict))
+        words = prompt.split() or ["stub"]
+        rng = random.Random(len(prompt))
+        return ["根據文件，"] + [rng.choice(words)[:20] + " " for _ in range(self.config.answer_tokens)]
+
+    def _chat(self, body: dict):
+        self.server.count("chat")
+        self._sleep(self.config.latency_ms)
+        if self._maybe_fail():
+            return
+        model = body.get("model", "gpt-4o-mini")
+        tokens = self._answer_tokens(body)
+        created = int(time.time())
+        completion_id = f"chatcmpl-stub-{random.getrandbits(48):x}"
+        usage = {
+            "prompt_tokens": 100,
+            "completion_tokens": len(tokens),
+            "total_tokens": 100 + len(tokens),
+        }
+        if not body.get("stream"):
+            self._send_json(
+                200,
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "".join(tokens)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def chunk(delta: dict, finish_reason=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            self.wfile.write(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        chunk({"role": "assistant", "content": ""})
+        for tok in tokens:
+            if self.config.stream_delay_ms:
+                time.sleep(self.config.stream_delay_ms / 1000)
+            chunk({"content": tok})
+        chunk({}, finish_reason="stop")
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config: StubConfig):
+        super().__init__(address, StubHandler)
+        self.config = config
+        self.counters = {"embeddings": 0, "chat": 0, "errors": 0}
+        self._counter_lock = threading.Lock()
+
+    def count(self, name: str):
+        with self._counter_lock:
+            self.counters[name] += 1
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def start_stub_server(
+    host: str = "127.0.0.1", port: int = 0, config: StubConfig = None
+) -> StubServer:
+    """
+    在背景 thread 啟動 stub server（port=0 會自動挑一個空的 port），回傳 server 物件。
+    """
+    server = StubServer((host, port), config or StubConfig())
+    threading.Thread(target=server.serve_forever, name="stub-openai", daemon=True).start()
+    return server
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="chat 回應延遲")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="延遲隨機抖動 ±")
+    parser.add_argument("--embedding-latency-ms", type=float, default=20.0, help="embeddings 回應延遲")
+    parser.add_argument("--stream-delay-ms", type=float, default=10.0, help="串流時每個 token 的間隔")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="隨機回傳 429/500/503 的機率")
+    parser.add_argument("--embedding-dim", type=int, default=256)
+    parser.add_argument("--answer-tokens", type=int, default=40)
+
+
+def config_from_args(args) -> StubConfig:
+    return StubConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        embedding_latency_ms=args.embedding_latency_ms,
+        stream_delay_ms=args.stream_delay_ms,
+        error_rate=args.error_rate,
+        embedding_dim=args.embedding_dim,
+        answer_tokens=args.answer_tokens,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stub server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_stub_arguments(parser)
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), config_from_args(args))
+    print(f"stub server listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# tests/test_chunker.py
+#
+# split_text_offsets / split_text_fast 必須與 RecursiveCharacterTextSplitter 切出完全相同的 chunk。
+# 用法：python -m pytest -q
+
+import random
+
+import pytest
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from rag_pipeline import (
+    CHUNK_OVERLAP,
+    CHUNK_SEPARATORS,
+    CHUNK_SIZE,
+    split_text_fast,
+    split_text_offsets,
+)
+
+ZH_WORDS = ["檢索", "增強", "生成", "向量", "資料庫", "文件", "摘要", "模型", "語意", "搜尋"]
+EN_WORDS = ["retrieval", "augmented", "generation", "vector", "index", "chunk", "the", "a"]
+PUNCT = ["。", "！", "？", " ", "\n", "\n\n", "\n\n\n", "，", "  ", "\t"]
+
+EDGE_CASES = ["", " ", "\n\n\n\n", "。。。", "a", "長" * 5000, "a\n\nb\n\n\nc " * 50]
+
+# 彼此共用字元的自訂分隔符（例如 "ab" / "aa" / "aab"），以前會與 re.split 的結果不同
+CUSTOM_SEPARATORS = [
+    ["ab", "\n", "aa", "", "。"],
+    ["aab", "ab", "a", " ", ""],
+    ["\n\n", "\n\n\n", "\n", " ", ""],
+    ["。\n", "。", "\n", ""],
+]
+
+
+def make_text(rng: random.Random, n_chars: int) -> str:
+    """
+    中英混合、段落長短不一的隨機文字，偶爾夾雜很長沒有分隔符的段落。
+    """
+    parts = []
+    size = 0
+    while size < n_chars:
+        r = rng.random()
+        if r < 0.4:
+            tok = rng.choice(ZH_WORDS)
+        elif r < 0.7:
+            tok = rng.choice(EN_WORDS) + " "
+        elif r < 0.8:
+            tok = rng.choice(["a", "b", "aa", "ab", "aab"])
+        elif r < 0.99:
+            tok = rng.choice(PUNCT)
+        else:
+            tok = "長" * rng.randint(50, 500)
+        parts.append(tok)
+        size += len(tok)
+    return "".join(parts)
+
+
+def reference_split(text, chunk_size, chunk_overlap, separators):
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separators=separators,
+    )
+    return splitter.split_text(text)
+
+
+def assert_same(text, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, separators=None):
+    separators = separators or CHUNK_SEPARATORS
+    expected = reference_split(text, chunk_size, chunk_overlap, separators)
+    actual = split_text_fast(text, chunk_size, chunk_overlap, separators)
+    assert actual == expected, (chunk_size, chunk_overlap, separators)
+
+
+@pytest.mark.parametrize("text", EDGE_CASES)
+@pytest.mark.parametrize("size,overlap", [(CHUNK_SIZE, CHUNK_OVERLAP), (7, 3), (1, 0), (5, 5)])
+def test_edge_cases(text, size, overlap):
+    assert_same(text, size, overlap)
+
+
+def test_offsets_point_into_text():
+    text = make_text(random.Random(0), 20000)
+    for s, e in split_text_offsets(text):
+        assert 0 <= s < e <= len(text)
+        assert e - s <= CHUNK_SIZE
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_fuzz_default_separators(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        text = make_text(rng, rng.randint(0, 3000))
+        size = rng.randint(1, 200)
+        overlap = rng.randint(0, size)
+        assert_same(text, size, overlap)
+
+
+@pytest.mark.parametrize("separators", CUSTOM_SEPARATORS)
+def test_fuzz_custom_separators(separators):
+    rng = random.Random(len(separators))
+    for _ in range(300):
+        text = make_text(rng, rng.randint(0, 1500))
+        size = rng.randint(1, 120)
+        overlap = rng.randint(0, size)
+        assert_same(text, size, overlap, separators)
+
+
+@pytest.mark.parametrize(
+    "size,overlap",
+    [(0, 0), (-1, 0), (10, -1), (10, 11)],
+)
+def test_invalid_arguments_raise(size, overlap):
+    with pytest.raises(ValueError):
+        RecursiveCharacterTextSplitter(chunk_size=size, chunk_overlap=overlap)
+    with pytest.raises(ValueError):
+        split_text_offsets("abc def", size, overlap)
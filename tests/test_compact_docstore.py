@@ -0,0 +1,76 @@
+# tests/test_compact_docstore.py
+#
+# CompactDocstore 的內容必須與一般 dict docstore 相同；刪除後要真的回收空間。
+
+import random
+
+from langchain_core.documents import Document
+
+from rag_pipeline import CompactDocstore
+
+
+def make_docs(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    docs = {}
+    for i in range(n):
+        text = rng.choice(["向量資料庫", "retrieval chunk ", "混合 mixed "]) * rng.randint(1, 30)
+        meta = {"source": f"file{i % 7}.txt", "chunk_id": i}
+        if i % 5 == 0:
+            meta["page"] = i // 5
+        docs[f"id-{i}"] = Document(page_content=text, metadata=meta)
+    return docs
+
+
+def assert_matches(store: CompactDocstore, expected: dict):
+    assert len(store) == len(expected)
+    assert list(store._dict) == list(expected)
+    for doc_id, doc in expected.items():
+        got = store.search(doc_id)
+        assert got.page_content == doc.page_content
+        assert got.metadata == doc.metadata
+    stats = store.stats()
+    assert stats["num_docs"] == len(expected)
+    assert stats["total_chars"] == sum(len(d.page_content) for d in expected.values())
+    for src, count in stats["per_source"].items():
+        assert count == sum(1 for d in expected.values() if d.metadata["source"] == src)
+        assert store.texts_for_source(src) == [
+            d.page_content for d in expected.values() if d.metadata["source"] == src
+        ]
+
+
+def test_roundtrip():
+    docs = make_docs(200)
+    assert_matches(CompactDocstore.from_documents(docs), docs)
+
+
+def test_delete_reclaims_space():
+    docs = make_docs(200)
+    store = CompactDocstore.from_documents(docs)
+    before = store.memory_bytes()
+    text_before = len(store._text)
+
+    doomed = [doc_id for doc_id, d in docs.items() if d.metadata["source"] != "file0.txt"]
+    store.delete(doomed)
+    for doc_id in doomed:
+        del docs[doc_id]
+
+    assert not store._deleted
+    assert len(store._row_ids) == len(docs)
+    assert store._source_names == ["file0.txt"]
+    assert len(store._text) < text_before / 2
+    assert store.memory_bytes() < before
+    assert_matches(store, docs)
+
+
+def test_small_deletes_then_add():
+    docs = make_docs(100)
+    store = CompactDocstore.from_documents(docs)
+    for doc_id in ["id-3", "id-50", "id-99"]:
+        store.delete([doc_id])
+        del docs[doc_id]
+    extra = make_docs(5, seed=1)
+    extra = {f"new-{k}": v for k, v in extra.items()}
+    store.add(extra)
+    docs.update(extra)
+    store.compact()
+    assert_matches(store, docs)
@@ -0,0 +1,41 @@
+# tests/test_result_cache.py
+#
+# ResultCache：多個 thread 共用時命中 / 未命中計數要正確，超過上限時依 LRU 淘汰。
+
+import threading
+import time
+
+from rag_pipeline import ResultCache
+
+
+def test_concurrent_counters(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"))
+    cache.put("hit", "value")
+
+    def worker():
+        for _ in range(50):
+            assert cache.get("hit") == "value"
+            assert cache.get("miss") is None
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    stats = cache.stats()
+    assert stats["hits"] == 400
+    assert stats["misses"] == 400
+    assert stats["entries"] == 1
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_bytes=10)
+    # last_used 是 time.time()，間隔一下避免時間解析度較粗的平台同分
+    for step in (lambda: cache.put("a", "aaaa"), lambda: cache.put("b", "bbbb"), lambda: cache.get("a")):
+        step()
+        time.sleep(0.02)
+    cache.put("c", "cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.get("c") == "cccc"
@@ -0,0 +1,73 @@
+# tests/test_snapshots.py
+#
+# 版本化快照：多個 writer 同時儲存時，CURRENT 一定指向存在且完整的版本。
+
+import os
+import threading
+
+import pytest
+
+from rag_pipeline import (
+    SNAPSHOT_VERSIONS_DIR,
+    get_current_version,
+    has_snapshot,
+    list_versions,
+    save_vector_store,
+)
+
+
+class FakeStore:
+    """
+    只實作 save_vector_store 會用到的 save_local，不需要 embeddings / FAISS。
+    """
+
+    def __init__(self, payload: bytes):
+        self.payload = payload
+
+    def save_local(self, folder_path: str):
+        os.makedirs(folder_path, exist_ok=True)
+        for name in ("index.faiss", "index.pkl"):
+            with open(os.path.join(folder_path, name), "wb") as f:
+                f.write(self.payload)
+
+
+@pytest.mark.parametrize("keep", [1, 3])
+def test_concurrent_writers_keep_current_valid(tmp_path, keep):
+    path = str(tmp_path / "db")
+    errors = []
+    published = []
+    lock = threading.Lock()
+
+    def writer(i: int):
+        for j in range(5):
+            try:
+                version = save_vector_store(FakeStore(b"x" * (i * 100 + j)), path, keep=keep)
+            except Exception as e:  # 任何一次發佈失敗都算錯
+                errors.append(e)
+                continue
+            with lock:
+                published.append(version)
+
+    for _ in range(5):
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert not errors
+        current = get_current_version(path)
+        assert current in published
+        assert os.path.isdir(os.path.join(path, SNAPSHOT_VERSIONS_DIR, current))
+        assert has_snapshot(path)
+        versions = list_versions(path)
+        assert current in versions
+        assert len(versions) <= keep + 1
+
+
+def test_save_returns_current_version(tmp_path):
+    path = str(tmp_path / "db")
+    first = save_vector_store(FakeStore(b"a"), path)
+    second = save_vector_store(FakeStore(b"b"), path)
+    assert get_current_version(path) == second
+    assert list_versions(path) == sorted([first, second])